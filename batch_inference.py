@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import time
+from contextlib import nullcontext
+
+import torch
+
+from dataset_utils import IMG_RE, iter_turns, load_dataset
+from feature_cache import VisualFeatureCache, model_revision
+from profiling import Tracer, instrument
+from qwen_utils import LOAD_VARIANTS, batch_chat, load_model, load_tokenizer
+from response_cache import ResponseCache, adapter_revision, cached_batch_chat
+
+
+def count_images(batch):
+    """Number of distinct images in the queries and histories of a batch"""
+    images = set()
+    for sample in batch:
+        for text in [sample['query']] + [q for q, _ in sample['history']]:
+            images.update(IMG_RE.findall(text))
+    return len(images)
+
+
+def iter_batches(samples, batch_size):
+    batch = []
+    for sample in samples:
+        batch.append(sample)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run(model, tokenizer, data_path, output_path, batch_size, response_cache=None, tracer=None):
+    """Answer every user turn of a dataset file and write the results as JSONL"""
+    entries = load_dataset(data_path)
+    samples = iter_turns(entries, os.path.dirname(os.path.abspath(data_path)))
+
+    n_samples = n_images = n_tokens = 0
+    start = time.perf_counter()
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for batch in iter_batches(samples, batch_size):
+            queries = [sample['query'] for sample in batch]
+            histories = [sample['history'] for sample in batch]
+            if tracer:
+                tracer.count("requests", len(batch))
+            with tracer.span("batch", samples=len(batch)) if tracer else nullcontext():
+                if response_cache:
+                    results = cached_batch_chat(response_cache, model, tokenizer, queries, histories)
+                else:
+                    results = batch_chat(model, tokenizer, queries, histories)
+            for sample, (response, generated) in zip(batch, results):
+                record = {
+                    "id": sample['id'],
+                    "turn": sample['turn'],
+                    "query": sample['query'],
+                    "response": response,
+                    "reference": sample['reference'],
+                    "box_frame": sample['box_frame'],
+                }
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                n_tokens += generated
+            n_samples += len(batch)
+            n_images += count_images(batch)
+
+    elapsed = time.perf_counter() - start
+    return {
+        "samples": n_samples,
+        "images": n_images,
+        "generated_tokens": n_tokens,
+        "seconds": elapsed,
+        "samples_per_s": n_samples / elapsed if elapsed else 0.0,
+        "images_per_s": n_images / elapsed if elapsed else 0.0,
+        "tokens_per_s": n_tokens / elapsed if elapsed else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched Qwen-VL inference over a Dataset.json file")
+    parser.add_argument("data_path", help="Dataset.json-format input")
+    parser.add_argument("output_path", help="JSONL file with one prediction per user turn")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--variant", choices=sorted(LOAD_VARIANTS), default="int4")
+    parser.add_argument("--feature-cache", help="Directory of the visual feature cache")
+    parser.add_argument("--feature-cache-mb", type=int, default=2048)
+    parser.add_argument("--response-cache", help="SQLite file of cached answers")
+    parser.add_argument("--response-cache-mb", type=int, default=256)
+    parser.add_argument("--bypass-response-cache", action="store_true",
+                        help="Generate every answer again and overwrite the cached ones")
+    parser.add_argument("--greedy", action="store_true",
+                        help="Decode greedily instead of sampling; sampled answers are never cached")
+    parser.add_argument("--trace", help="Write a Chrome trace of the inference stages here (and a .prom snapshot)")
+    args = parser.parse_args()
+
+    torch.manual_seed(1234)
+    tokenizer = load_tokenizer()
+    model = load_model(args.variant)
+    if args.greedy:
+        model.generation_config.do_sample = False
+
+    cache = None
+    if args.feature_cache:
+        cache = VisualFeatureCache(args.feature_cache, args.feature_cache_mb << 20, model_revision(model))
+        cache.install(model)
+
+    response_cache = None
+    if args.response_cache:
+        response_cache = ResponseCache(args.response_cache, args.response_cache_mb << 20,
+                                       adapter_revision(model), bypass=args.bypass_response_cache)
+        if model.generation_config.do_sample:
+            print("Response cache: the generation config samples, answers will not be cached (see --greedy)")
+
+    tracer = Tracer(enabled=bool(args.trace))
+    instrument(model, tokenizer, tracer)
+
+    stats = run(model, tokenizer, args.data_path, args.output_path, args.batch_size, response_cache, tracer)
+    print(f"{stats['samples']} samples in {stats['seconds']:.1f}s: "
+          f"{stats['images_per_s']:.2f} images/s, {stats['tokens_per_s']:.1f} tokens/s")
+    if cache:
+        print(f"Feature cache: {cache.hits} hits, {cache.misses} misses")
+    if response_cache:
+        print(f"Response cache: {response_cache.hits} hits, {response_cache.misses} misses, "
+              f"{response_cache.sampled} sampled")
+        response_cache.close()
+    if args.trace:
+        tracer.write_chrome_trace(args.trace)
+        with open(os.path.splitext(args.trace)[0] + ".prom", 'w', encoding='utf-8') as f:
+            f.write(tracer.prometheus())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import torch
+
+from dataset_utils import iter_turns, load_dataset
+from qwen_utils import LOAD_VARIANTS, load_model, load_tokenizer
+from streaming import ChatStream
+
+DEFAULT_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset", "Dataset.json")
+
+
+def unavailable_reason(variant):
+    """Why a load configuration cannot run on this machine, or None"""
+    if variant == "cpu":
+        return None
+    if variant == "int8-cpu":
+        engines = set(torch.backends.quantized.supported_engines)
+        return None if engines & {"x86", "fbgemm", "qnnpack"} else "PyTorch has no quantized CPU engine"
+    if not torch.cuda.is_available():
+        return "CUDA is not available"
+    if variant == "bf16" and not torch.cuda.is_bf16_supported():
+        return "GPU has no bf16 support"
+    if variant == "int4" and importlib.util.find_spec("auto_gptq") is None:
+        return "auto-gptq is not installed"
+    return None
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MiB, or None where it cannot be measured"""
+    try:
+        import resource
+    except ImportError:
+        # No resource module on Windows
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 2**20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def build_prompts(data_path, limit):
+    """First-turn questions of the first `limit` dataset records"""
+    entries = load_dataset(data_path)
+    root = os.path.dirname(os.path.abspath(data_path))
+    return [sample['query'] for sample in iter_turns(entries, root) if sample['turn'] == 0][:limit]
+
+
+def run_variant(variant, prompts, max_new_tokens):
+    torch.manual_seed(1234)
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.perf_counter()
+    tokenizer = load_tokenizer()
+    model = load_model(variant)
+    load_seconds = time.perf_counter() - start
+
+    model.generation_config.max_new_tokens = max_new_tokens
+
+    # Warm-up run is not measured
+    if prompts:
+        list(ChatStream(model, tokenizer, prompts[0]))
+
+    latencies, prefill, decode = [], [], []
+    for query in prompts:
+        stream = ChatStream(model, tokenizer, query)
+        start = time.perf_counter()
+        for _ in stream:
+            pass
+        latencies.append(time.perf_counter() - start)
+        if stream.timings.time_to_first_token is not None:
+            prefill.append(stream.timings.time_to_first_token)
+        if stream.timings.decode_tokens_per_s is not None:
+            decode.append(stream.timings.decode_tokens_per_s)
+
+    return {
+        "load_seconds": load_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_vram_mb": torch.cuda.max_memory_allocated() / 2 ** 20 if torch.cuda.is_available() else None,
+        "prefill_seconds_p50": percentile(prefill, 50),
+        "decode_tokens_per_s": sum(decode) / len(decode) if decode else None,
+        "latency_seconds_p50": percentile(latencies, 50),
+        "latency_seconds_p95": percentile(latencies, 95),
+        "prompts": len(prompts),
+    }
+
+
+def run_isolated(variant, args):
+    """Run one configuration in a fresh process so that peak memory is not shared"""
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        "--worker", variant,
+        "--data", args.data,
+        "--limit", str(args.limit),
+        "--max-new-tokens", str(args.max_new_tokens),
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the Qwen-VL loading variants on a fixed prompt set")
+    parser.add_argument("--variants", nargs="+", choices=sorted(LOAD_VARIANTS), default=sorted(LOAD_VARIANTS))
+    parser.add_argument("--data", default=DEFAULT_DATA)
+    parser.add_argument("--limit", type=int, default=10, help="Number of prompts")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    prompts = build_prompts(args.data, args.limit)
+    if not prompts:
+        parser.error(f"{args.data} has no user turns to use as prompts")
+
+    if args.worker:
+        print(json.dumps(run_variant(args.worker, prompts, args.max_new_tokens)))
+        return
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "device": torch.cuda.get_device_name(0) if torch.cuda.is_available() else platform.processor() or "cpu",
+        "prompts": len(prompts),
+        "max_new_tokens": args.max_new_tokens,
+        "results": {},
+    }
+    for variant in args.variants:
+        reason = unavailable_reason(variant)
+        if reason:
+            report["results"][variant] = {"skipped": reason}
+            continue
+        report["results"][variant] = run_isolated(variant, args)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
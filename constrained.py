@@ -0,0 +1,142 @@
+import copy
+import weakref
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList
+
+from dataset_utils import parse_boxes
+from qwen_utils import DEFAULT_SYSTEM, batch_chat
+
+# "(x1,y1),(x2,y2)" between <box> and </box>; None stands for a number
+BOX_PARTS = ("(", None, ",", None, ")", ",", "(", None, ",", None, ")")
+BOX_CHARS = set("0123456789(),")
+DIGITS = set("0123456789")
+MAX_DIGITS = 4
+
+# Per tokenizer, dropped with it
+_BOX_TOKENS = weakref.WeakKeyDictionary()
+_ALLOWED_BOX_TOKENS = weakref.WeakKeyDictionary()
+
+
+def advance_box(state, text):
+    """Feed text to the box grammar; returns the new (part, digits) state or None if it is invalid"""
+    part, digits = state
+    for c in text:
+        while True:
+            if part == len(BOX_PARTS):
+                return None
+            expected = BOX_PARTS[part]
+            if expected is None:
+                if c in DIGITS and digits < MAX_DIGITS:
+                    digits += 1
+                    break
+                if digits == 0:
+                    return None
+                # The number is over, c has to match the next literal
+                part, digits = part + 1, 0
+                continue
+            if c != expected:
+                return None
+            part += 1
+            break
+    return part, digits
+
+
+def box_tokens(tokenizer):
+    """{token id: text} of every token made only of digits, commas and parentheses"""
+    if tokenizer not in _BOX_TOKENS:
+        tokens = {}
+        for token_bytes, token_id in tokenizer.mergeable_ranks.items():
+            try:
+                text = token_bytes.decode('utf-8')
+            except UnicodeDecodeError:
+                continue
+            if text and set(text) <= BOX_CHARS:
+                tokens[token_id] = text
+        _BOX_TOKENS[tokenizer] = tokens
+    return _BOX_TOKENS[tokenizer]
+
+
+def allowed_box_tokens(tokenizer, state):
+    """Box tokens that keep the grammar valid in a (part, digits) state, computed once per state"""
+    allowed = _ALLOWED_BOX_TOKENS.setdefault(tokenizer, {})
+    if state not in allowed:
+        allowed[state] = [token for token, text in box_tokens(tokenizer).items()
+                          if advance_box(state, text) is not None]
+    return allowed[state]
+
+
+class GroundingLogitsProcessor(LogitsProcessor):
+    """Restricts generation to "<ref>X</ref><box>(x1,y1),(x2,y2)</box>" and ends it after </box>.
+
+    The ref text of every row is forced from the field asked for, the box is
+    limited to the grammar above, and <|im_end|> is forced once </box>
+    closes, so the answer takes as many decode steps as its tokens. The
+    state is recomputed from the generated tokens at every step, which
+    keeps the processor independent of batch order and beam reordering.
+    """
+
+    def __init__(self, tokenizer, refs):
+        self.prefixes = [
+            [tokenizer.ref_start_id] + tokenizer.encode(ref) + [tokenizer.ref_end_id, tokenizer.box_start_id]
+            for ref in refs
+        ]
+        self.tokenizer = tokenizer
+        self.box_tokens = box_tokens(tokenizer)
+        self.box_end_id = tokenizer.box_end_id
+        self.end_id = tokenizer.im_end_id
+        self.prompt_len = None
+
+    def allowed(self, row, generated):
+        prefix = self.prefixes[row]
+        if len(generated) < len(prefix):
+            return [prefix[len(generated)]]
+
+        box = generated[len(prefix):]
+        if self.box_end_id in box or self.end_id in box:
+            return [self.end_id]
+        state = (0, 0)
+        for token in box:
+            state = advance_box(state, self.box_tokens[token])
+        if state[0] == len(BOX_PARTS):
+            return [self.box_end_id]
+        return allowed_box_tokens(self.tokenizer, state)
+
+    def __call__(self, input_ids, scores):
+        # Left-padded prompts all end at the same position
+        if self.prompt_len is None:
+            self.prompt_len = input_ids.shape[1]
+        mask = torch.full_like(scores, float("-inf"))
+        for row in range(input_ids.shape[0]):
+            generated = input_ids[row, self.prompt_len:].tolist()
+            # Rows of the same query are adjacent when generate expands them (beams, several samples)
+            mask[row, self.allowed(row * len(self.prefixes) // input_ids.shape[0], generated)] = 0
+        return scores + mask
+
+
+def max_answer_tokens(tokenizer, ref):
+    """Upper bound of the answer length in tokens"""
+    forced = len(tokenizer.encode(ref)) + 3
+    box = 4 * MAX_DIGITS + 7
+    return forced + box + 2
+
+
+def batch_ground(model, tokenizer, queries, refs, histories=None, system=DEFAULT_SYSTEM, generation_config=None):
+    """Answer grounding queries under the ref/box grammar.
+
+    refs holds the field named by every query ("Поставщик" for "Отметьте
+    Поставщик"). Returns [(response, boxes, generated_tokens)] where boxes
+    are parsed like dataset_utils.parse_boxes.
+    """
+    generation_config = copy.deepcopy(generation_config or model.generation_config)
+    generation_config.max_new_tokens = max(max_answer_tokens(tokenizer, ref) for ref in refs)
+    processor = GroundingLogitsProcessor(tokenizer, refs)
+    results = batch_chat(model, tokenizer, queries, histories, system, generation_config,
+                         logits_processor=LogitsProcessorList([processor]))
+    return [(response, parse_boxes(response), generated) for response, generated in results]
+
+
+def ground(model, tokenizer, query, ref, history=None, system=DEFAULT_SYSTEM, generation_config=None):
+    """Constrained single grounding answer: (response, boxes)"""
+    response, boxes, _ = batch_ground(model, tokenizer, [query], [ref], [history], system, generation_config)[0]
+    return response, boxes
@@ -0,0 +1,165 @@
+import argparse
+import html
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from PIL import Image, ImageDraw
+
+from dataset_utils import (DISPLAY_FRAME, IMAGE_FRAME, IMG_RE, NORM1000_FRAME, box_frame, frame_scale, parse_boxes,
+                           scale_boxes)
+from evaluation import load_predictions, match_boxes
+
+PRED_COLOR = (220, 30, 30)
+GOLD_COLOR = (30, 170, 60)
+CAPTION_HEIGHT = 18
+# Frame of the record's own boxes: its box_frame, "display" when it has none
+AUTO_FRAME = "auto"
+FRAMES = (AUTO_FRAME, DISPLAY_FRAME, IMAGE_FRAME, NORM1000_FRAME)
+
+
+def _frames(record, pred_coords, gold_coords):
+    """Frames of the predicted and gold boxes; predictions default to the frame they were trained on"""
+    gold_frame = box_frame(record) if gold_coords == AUTO_FRAME else gold_coords
+    return gold_frame if pred_coords == AUTO_FRAME else pred_coords, gold_frame
+
+
+def _image_size(record):
+    match = IMG_RE.search(record['query'])
+    try:
+        with Image.open(match.group(1)) as image:
+            return image.size
+    except (AttributeError, OSError):
+        return None
+
+
+def record_matches(record, pred_coords=AUTO_FRAME, gold_coords=AUTO_FRAME, threshold=0.5):
+    """Whether every gold box is matched one-to-one to a predicted box with the same ref"""
+    pred = parse_boxes(record['response'])
+    gold = parse_boxes(record['reference'])
+    if not gold or not pred:
+        return not gold and not pred
+    pred_frame, gold_frame = _frames(record, pred_coords, gold_coords)
+    # IoU does not change under scaling, boxes of the same frame compare as they are
+    if pred_frame != gold_frame:
+        size = _image_size(record)
+        if size is None:
+            return False
+        pred = scale_boxes(pred, *frame_scale(pred_frame, *size))
+        gold = scale_boxes(gold, *frame_scale(gold_frame, *size))
+    return bool((match_boxes(pred, gold) >= threshold).all())
+
+
+def render_tile(record, tile_size, pred_coords, gold_coords):
+    """Thumbnail of the record's image with gold boxes in green and predictions in red"""
+    tile = Image.new("RGB", (tile_size, tile_size + CAPTION_HEIGHT), "white")
+    draw = ImageDraw.Draw(tile)
+    caption = f"{record['id']} #{record['turn']}"
+
+    match = IMG_RE.search(record['query'])
+    try:
+        image = Image.open(match.group(1)) if match else None
+    except OSError:
+        image = None
+    if image is None:
+        draw.text((4, 4), "image not found", fill=PRED_COLOR)
+    else:
+        with image:
+            width, height = image.size
+            if image.format == "JPEG":
+                image.draft("RGB", (tile_size, tile_size))
+            thumb = image.convert("RGB")
+            thumb.thumbnail((tile_size, tile_size), Image.Resampling.BILINEAR)
+        tile.paste(thumb, (0, 0))
+        sx, sy = thumb.width / width, thumb.height / height
+        pred_frame, gold_frame = _frames(record, pred_coords, gold_coords)
+        for text, frame, color in ((record['reference'], gold_frame, GOLD_COLOR),
+                                   (record['response'], pred_frame, PRED_COLOR)):
+            boxes = scale_boxes(scale_boxes(parse_boxes(text), *frame_scale(frame, width, height)), sx, sy)
+            for ref, (x1, y1, x2, y2) in boxes:
+                draw.rectangle((x1, y1, x2, y2), outline=color, width=2)
+                draw.text((x1 + 2, max(0, y1 - 11)), ref, fill=color)
+
+    draw.text((4, tile_size + 3), caption, fill=(0, 0, 0) if record['match'] else PRED_COLOR)
+    return tile
+
+
+def render_sheet(args):
+    """Render one page of tiles to disk; runs in a worker process"""
+    path, records, columns, tile_size, pred_coords, gold_coords = args
+    rows = (len(records) + columns - 1) // columns
+    sheet = Image.new("RGB", (columns * tile_size, rows * (tile_size + CAPTION_HEIGHT)), (235, 235, 235))
+    for i, record in enumerate(records):
+        x, y = (i % columns) * tile_size, (i // columns) * (tile_size + CAPTION_HEIGHT)
+        sheet.paste(render_tile(record, tile_size, pred_coords, gold_coords), (x, y))
+    sheet.save(path, "JPEG", quality=85)
+    return path
+
+
+def write_index(out_dir, pages):
+    """HTML index with one section per sheet listing the records on it"""
+    parts = [
+        "<!DOCTYPE html><html><head><meta charset='utf-8'><title>Predictions</title>",
+        "<style>body{font-family:sans-serif} img{max-width:100%} .miss{color:#dc1e1e}</style></head><body>",
+        f"<p>{sum(len(records) for _, records in pages)} predictions on {len(pages)} sheets. "
+        "Gold boxes are green, predictions red; captions of mismatches are red.</p>",
+    ]
+    for path, records in pages:
+        name = os.path.basename(path)
+        parts.append(f"<h2 id='{name}'><a href='{name}'>{name}</a></h2><p>")
+        parts.append(", ".join(
+            f"<span class='{'' if r['match'] else 'miss'}'>{html.escape(str(r['id']))} #{r['turn']}</span>"
+            for r in records))
+        parts.append(f"</p><a href='{name}'><img src='{name}' loading='lazy'></a>")
+    parts.append("</body></html>")
+    with open(os.path.join(out_dir, "index.html"), 'w', encoding='utf-8') as f:
+        f.write("\n".join(parts))
+
+
+def render(records, out_dir, columns=6, rows=5, tile_size=320, pred_coords=AUTO_FRAME, gold_coords=AUTO_FRAME,
+           only_mismatches=False, workers=None):
+    """Render prediction records to contact sheets; returns the sheet paths"""
+    os.makedirs(out_dir, exist_ok=True)
+    per_page = columns * rows
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        matches = pool.map(partial(record_matches, pred_coords=pred_coords, gold_coords=gold_coords),
+                           records, chunksize=64)
+        records = [dict(r, match=match) for r, match in zip(records, matches)]
+        if only_mismatches:
+            records = [r for r in records if not r['match']]
+
+        pages = [
+            (os.path.join(out_dir, f"sheet-{i // per_page + 1:04d}.jpg"), records[i:i + per_page])
+            for i in range(0, len(records), per_page)
+        ]
+        list(pool.map(render_sheet, [
+            (path, page_records, columns, tile_size, pred_coords, gold_coords) for path, page_records in pages
+        ]))
+    write_index(out_dir, pages)
+    return [path for path, _ in pages]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render predicted and gold boxes to contact sheets for review")
+    parser.add_argument("predictions", help="JSONL written by batch_inference.py")
+    parser.add_argument("out_dir", help="Directory of the sheets and index.html")
+    parser.add_argument("--gold", help="Dataset.json to take the references from instead of the JSONL")
+    parser.add_argument("--columns", type=int, default=6)
+    parser.add_argument("--rows", type=int, default=5)
+    parser.add_argument("--tile-size", type=int, default=320)
+    parser.add_argument("--pred-coords", choices=FRAMES, default=AUTO_FRAME,
+                        help="norm1000 for answers of the base model, which uses a 0..1000 grid; "
+                             "auto takes the frame of the gold boxes")
+    parser.add_argument("--gold-coords", choices=FRAMES, default=AUTO_FRAME,
+                        help="auto takes the box_frame of every record (display for legacy annotations)")
+    parser.add_argument("--only-mismatches", action="store_true", help="Skip records whose boxes match at IoU 0.5")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    sheets = render(load_predictions(args.predictions, args.gold), args.out_dir, args.columns, args.rows,
+                    args.tile_size, args.pred_coords, args.gold_coords, args.only_mismatches, args.workers)
+    print(f"{len(sheets)} sheets, index at {os.path.join(args.out_dir, 'index.html')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import queue
+import time
+import traceback
+from contextlib import contextmanager
+
+import torch
+
+from batch_inference import count_images, iter_batches
+from dataset_utils import iter_turns, load_dataset
+from qwen_utils import LOAD_VARIANTS, batch_chat, load_model, load_tokenizer
+
+
+# Thread pool sizes a spawned child reads when it imports torch
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+def usable_cores():
+    """Cores this process may run on; all of them where affinity is not supported (macOS, Windows)"""
+    if hasattr(os, "sched_getaffinity"):
+        return os.sched_getaffinity(0)
+    return range(os.cpu_count() or 1)
+
+
+@contextmanager
+def thread_env(n_threads):
+    """Set the thread pool sizes for processes started in the block, restoring them afterwards"""
+    saved = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    os.environ.update({name: str(n_threads) for name in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def core_groups(n_workers, cores=None):
+    """Split the usable cores into n_workers contiguous groups"""
+    cores = sorted(cores if cores is not None else usable_cores())
+    n_workers = max(1, min(n_workers, len(cores)))
+    size, extra = divmod(len(cores), n_workers)
+    groups, start = [], 0
+    for i in range(n_workers):
+        end = start + size + (i < extra)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def _answer(model, tokenizer, samples, batch_size):
+    """Prediction records of a chunk of samples and the number of generated tokens"""
+    records, n_tokens = [], 0
+    for batch in iter_batches(samples, batch_size):
+        answers = batch_chat(
+            model, tokenizer,
+            [sample['query'] for sample in batch],
+            [sample['history'] for sample in batch],
+        )
+        for sample, (response, generated) in zip(batch, answers):
+            records.append({
+                "id": sample['id'],
+                "turn": sample['turn'],
+                "query": sample['query'],
+                "response": response,
+                "reference": sample['reference'],
+                "box_frame": sample['box_frame'],
+            })
+            n_tokens += generated
+    return records, n_tokens
+
+
+def _worker(rank, cores, variant, batch_size, tasks, results):
+    """Inference process pinned to its own cores; answers (index, samples) chunks.
+
+    A failure is sent back as ("error", rank, traceback) and ends the worker.
+    """
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+        torch.set_num_interop_threads(1)
+        torch.manual_seed(1234)
+        tokenizer = load_tokenizer()
+        model = load_model(variant)
+    except Exception:
+        results.put(("error", rank, f"loading the model:\n{traceback.format_exc()}"))
+        return
+    results.put(("ready", rank, None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, samples = task
+        try:
+            records, n_tokens = _answer(model, tokenizer, samples, batch_size)
+        except Exception:
+            results.put(("error", rank, f"chunk {index}:\n{traceback.format_exc()}"))
+            return
+        results.put((index, records, n_tokens))
+
+
+def _next_result(results, processes, timeout=None, poll=1.0):
+    """Next message of the workers; raises RuntimeError if they died or nothing arrived within timeout"""
+    waited = 0.0
+    exited = False
+    while True:
+        try:
+            return results.get(timeout=poll)
+        except queue.Empty:
+            pass
+        waited += poll
+        crashed = [rank for rank, process in enumerate(processes) if process.exitcode not in (None, 0)]
+        if crashed:
+            codes = ", ".join(f"{rank} ({processes[rank].exitcode})" for rank in crashed)
+            raise RuntimeError(f"workers exited unexpectedly: {codes}")
+        if all(process.exitcode is not None for process in processes):
+            # Give results queued right before the exit one more poll
+            if exited:
+                raise RuntimeError("all workers exited before the last chunk was answered")
+            exited = True
+        if timeout is not None and waited >= timeout:
+            raise RuntimeError(f"no result from the workers in {timeout:.0f}s")
+
+
+def run(data_path, output_path, n_workers, variant="cpu", batch_size=4, chunk_size=8, timeout=None):
+    """Answer every user turn of a dataset with n_workers pinned model processes.
+
+    Workers pull small chunks from one shared queue, so a fast worker simply
+    takes more of them; results are reordered and written in input order.
+    Every worker holds its own copy of the weights; the checkpoint is read
+    through safetensors' mmap, so the page cache keeps a single copy of the
+    file while the workers load. A worker failure, or no result within
+    timeout seconds, stops all workers and raises RuntimeError.
+    """
+    entries = load_dataset(data_path)
+    samples = list(iter_turns(entries, os.path.dirname(os.path.abspath(data_path))))
+    chunks = list(iter_batches(samples, chunk_size))
+
+    context = mp.get_context("spawn")
+    tasks = context.Queue()
+    results = context.Queue()
+    processes = []
+    for rank, cores in enumerate(core_groups(n_workers)):
+        process = context.Process(
+            target=_worker, args=(rank, cores, variant, batch_size, tasks, results), daemon=True)
+        # Spawned children read the thread budget at torch import
+        with thread_env(len(cores)):
+            process.start()
+        processes.append(process)
+
+    for index, chunk in enumerate(chunks):
+        tasks.put((index, chunk))
+    for _ in processes:
+        tasks.put(None)
+
+    # Model loading is not part of the measured time
+    ready = 0
+    n_tokens = 0
+    done, next_index = {}, 0
+    start = time.perf_counter()
+    try:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            while next_index < len(chunks):
+                index, records, generated = _next_result(results, processes, timeout)
+                if index == "error":
+                    raise RuntimeError(f"worker {records} failed in {generated}")
+                if index == "ready":
+                    ready += 1
+                    if ready == len(processes):
+                        start = time.perf_counter()
+                    continue
+                done[index] = records
+                n_tokens += generated
+                while next_index in done:
+                    for record in done.pop(next_index):
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    next_index += 1
+        elapsed = time.perf_counter() - start
+    finally:
+        for process in processes:
+            if next_index < len(chunks):
+                process.terminate()
+            process.join()
+    n_images = sum(count_images(batch) for chunk in chunks for batch in iter_batches(chunk, batch_size))
+    return {
+        "workers": len(processes),
+        "samples": len(samples),
+        "images": n_images,
+        "generated_tokens": n_tokens,
+        "seconds": elapsed,
+        "samples_per_s": len(samples) / elapsed if elapsed else 0.0,
+        "images_per_s": n_images / elapsed if elapsed else 0.0,
+        "tokens_per_s": n_tokens / elapsed if elapsed else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Data-parallel Qwen-VL inference on CPU cores")
+    parser.add_argument("data_path", help="Dataset.json-format input")
+    parser.add_argument("output_path", help="JSONL file with one prediction per user turn")
+    parser.add_argument("--workers", type=int, default=max(1, len(usable_cores()) // 8),
+                        help="Model processes; the usable cores are split evenly between them")
+    parser.add_argument("--variant", choices=sorted(LOAD_VARIANTS), default="cpu")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=8, help="Samples handed to a worker at a time")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="Fail when no worker reports anything for this many seconds")
+    args = parser.parse_args()
+
+    stats = run(args.data_path, args.output_path, args.workers, args.variant, args.batch_size, args.chunk_size,
+                args.timeout)
+    print(f"{stats['samples']} samples on {stats['workers']} workers in {stats['seconds']:.1f}s: "
+          f"{stats['samples_per_s']:.2f} samples/s, {stats['tokens_per_s']:.1f} tokens/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+
+from dataset_store import identity_number
+from dataset_utils import (IMAGE_FRAME, IMG_RE, box_frame, find_image, image_digest, is_url, iter_dataset,
+                           resolve_image, to_image_frame)
+
+
+class JsonArrayWriter:
+    """Writes entries one at a time, formatted like json.dump(..., indent=2).
+
+    Entries go to a .tmp file next to the output; commit() replaces the
+    output with it, abort() deletes it and leaves the output untouched.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._tmp_path = path + ".tmp"
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(self._tmp_path, 'w', encoding='utf-8')
+        self._file.write("[")
+
+    def write(self, entry):
+        text = json.dumps(entry, ensure_ascii=False, indent=2)
+        self._file.write(("," if self.count else "") + "\n  " + text.replace("\n", "\n  "))
+        self.count += 1
+
+    def commit(self):
+        self._file.write("\n]" if self.count else "]")
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class SeenSet:
+    """Set of keys kept in a temporary on-disk SQLite database instead of memory"""
+
+    def __init__(self):
+        # An empty path makes SQLite use a private temporary file
+        self.conn = sqlite3.connect("")
+        self.conn.execute("CREATE TABLE seen (key BLOB PRIMARY KEY)")
+
+    def add(self, key):
+        """Add a key; returns False when it was already present"""
+        return self.conn.execute("INSERT OR IGNORE INTO seen VALUES (?)", (key,)).rowcount == 1
+
+    def close(self):
+        self.conn.close()
+
+
+def rebase_images(entry, root, out_root):
+    """Rewrite image references of an entry from its file's folder to the output folder"""
+    if root == out_root:
+        return entry
+
+    def rebase(match):
+        ref = match.group(1)
+        if is_url(ref) or os.path.isabs(ref):
+            return match.group(0)
+        return f"<img>{os.path.relpath(resolve_image(ref, root), out_root)}</img>"
+
+    return dict(entry, conversations=[
+        dict(msg, value=IMG_RE.sub(rebase, msg['value'])) for msg in entry['conversations']
+    ])
+
+
+def conversation_hash(entry):
+    """Digest of the conversation of an entry, independent of its id and image folders"""
+    conversations = [
+        {"from": msg['from'], "value": IMG_RE.sub(lambda m: f"<img>{os.path.basename(m.group(1))}</img>", msg['value'])}
+        for msg in entry['conversations']
+    ]
+    return hashlib.sha256(json.dumps(conversations, ensure_ascii=False).encode('utf-8')).digest()
+
+
+def merge(paths, output_path, dedup=True, start_id=1):
+    """Merge dataset files into one, renumbering identity_N ids; returns counts"""
+    out_root = os.path.dirname(os.path.abspath(output_path))
+    writer = JsonArrayWriter(output_path)
+    hashes = SeenSet()
+    other_ids = SeenSet()
+    next_id = start_id
+    read = duplicates = renamed = 0
+    try:
+        for path in paths:
+            root = os.path.dirname(os.path.abspath(path))
+            for entry in iter_dataset(path):
+                read += 1
+                if dedup and not hashes.add(conversation_hash(entry)):
+                    duplicates += 1
+                    continue
+
+                entry_id = entry['id']
+                if identity_number(entry_id) is not None:
+                    entry_id = f"identity_{next_id}"
+                    next_id += 1
+                elif not other_ids.add(entry_id):
+                    # Custom ids are kept unless another file already used them
+                    entry_id = f"identity_{next_id}"
+                    next_id += 1
+                    renamed += 1
+                writer.write(dict(rebase_images(entry, root, out_root), id=entry_id))
+        writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        hashes.close()
+        other_ids.close()
+    return {"read": read, "written": writer.count, "duplicates": duplicates, "renamed": renamed}
+
+
+def image_group(entry, root):
+    """Split group of an entry: the content hash of its image, or the reference if it is unreadable"""
+    image_ref = find_image(entry)
+    if not image_ref:
+        return entry['id']
+    try:
+        return image_digest(resolve_image(image_ref, root))
+    except OSError:
+        return os.path.basename(image_ref)
+
+
+def in_test_split(group, test_fraction, seed=""):
+    digest = hashlib.sha256(f"{seed}:{group}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64 < test_fraction
+
+
+def split(path, train_path, test_path, test_fraction=0.1, seed=""):
+    """Deterministic train/test split keeping all entries of an image on one side"""
+    root = os.path.dirname(os.path.abspath(path))
+    writers = {
+        False: JsonArrayWriter(train_path),
+        True: JsonArrayWriter(test_path),
+    }
+    try:
+        for entry in iter_dataset(path):
+            is_test = in_test_split(image_group(entry, root), test_fraction, seed)
+            out_root = os.path.dirname(os.path.abspath(writers[is_test].path))
+            writers[is_test].write(rebase_images(entry, root, out_root))
+        for writer in writers.values():
+            writer.commit()
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+    return {"train": writers[False].count, "test": writers[True].count}
+
+
+def migrate_boxes(path, output_path):
+    """Convert boxes of entries in legacy display pixels to original image pixels.
+
+    Converted entries get "box_frame": "image", so running the migration
+    again leaves them alone. Entries whose image cannot be opened are copied
+    unchanged and listed in the result. Migrating in place first copies the
+    input to <path>.bak.
+    """
+    root = os.path.dirname(os.path.abspath(path))
+    out_root = os.path.dirname(os.path.abspath(output_path))
+    backup = None
+    if os.path.abspath(output_path) == os.path.abspath(path):
+        backup = path + ".bak"
+        shutil.copy2(path, backup)
+    writer = JsonArrayWriter(output_path)
+    converted = 0
+    failed = []
+    try:
+        for entry in iter_dataset(path):
+            if box_frame(entry) != IMAGE_FRAME:
+                try:
+                    entry = to_image_frame(entry, root)
+                    converted += 1
+                except OSError:
+                    failed.append(entry['id'])
+            writer.write(rebase_images(entry, root, out_root))
+        writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+    return {"written": writer.count, "converted": converted, "failed": failed, "backup": backup}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge and split Dataset.json-format annotation files")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    merge_parser = commands.add_parser("merge", help="Merge files, renumber identity_N ids and drop duplicates")
+    merge_parser.add_argument("paths", nargs="+", help="Dataset.json-format inputs")
+    merge_parser.add_argument("-o", "--output", required=True)
+    merge_parser.add_argument("--keep-duplicates", action="store_true", help="Keep identical conversations")
+    merge_parser.add_argument("--start-id", type=int, default=1, help="First identity_N number")
+
+    split_parser = commands.add_parser("split", help="Split a file into train and test by image")
+    split_parser.add_argument("path", help="Dataset.json-format input")
+    split_parser.add_argument("--train", required=True, help="Output for the training split")
+    split_parser.add_argument("--test", required=True, help="Output for the test split")
+    split_parser.add_argument("--test-fraction", type=float, default=0.1)
+    split_parser.add_argument("--seed", default="", help="Changes the assignment of image groups")
+
+    migrate_parser = commands.add_parser("migrate-boxes",
+                                         help="Convert boxes drawn on the 800x600 preview to image pixels")
+    migrate_parser.add_argument("path", help="Dataset.json-format input")
+    migrate_parser.add_argument("-o", "--output",
+                                help="Output file; by default the input is replaced after a successful run "
+                                     "and the original kept as <path>.bak")
+
+    args = parser.parse_args()
+    if args.command == "merge":
+        stats = merge(args.paths, args.output, not args.keep_duplicates, args.start_id)
+    elif args.command == "migrate-boxes":
+        stats = migrate_boxes(args.path, args.output or args.path)
+    else:
+        stats = split(args.path, args.train, args.test, args.test_fraction, args.seed)
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import json
+import os
+import sqlite3
+
+from dataset_utils import find_image, parse_boxes
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    image TEXT,
+    box_frame TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_position ON entries(position);
+CREATE INDEX IF NOT EXISTS entries_image ON entries(image);
+
+CREATE TABLE IF NOT EXISTS messages (
+    entry_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (entry_id, idx)
+);
+
+CREATE TABLE IF NOT EXISTS boxes (
+    entry_id TEXT NOT NULL,
+    message_idx INTEGER NOT NULL,
+    ref TEXT,
+    x1 INTEGER, y1 INTEGER, x2 INTEGER, y2 INTEGER
+);
+CREATE INDEX IF NOT EXISTS boxes_entry ON boxes(entry_id);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def identity_number(entry_id):
+    """N of an "identity_N" id, None for other ids"""
+    if entry_id.startswith("identity_"):
+        try:
+            return int(entry_id.split("_")[1])
+        except ValueError:
+            pass
+    return None
+
+
+class DatasetStore:
+    """SQLite storage of dataset entries, their conversation turns and boxes.
+
+    Every save or delete is a single short transaction. The next free
+    identity_N and the next list position are kept in the meta table, so
+    adding an entry never scans the dataset. The meta table also records the
+    size and mtime of the JSON file last imported or exported and whether
+    entries changed since, which tells a sidecar store that is still in sync
+    with its JSON from one that is not.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+        # Stores created before entries had a box frame
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(entries)")]
+        if "box_frame" not in columns:
+            self.conn.execute("ALTER TABLE entries ADD COLUMN box_frame TEXT")
+
+    def close(self):
+        self.conn.close()
+
+    def _meta(self, key, default):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def next_id(self):
+        return self._meta("next_id", 1)
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _insert(self, entry, position):
+        entry_id = entry['id']
+        self.conn.execute("INSERT INTO entries (id, position, image, box_frame) VALUES (?, ?, ?, ?)",
+                          (entry_id, position, find_image(entry), entry.get('box_frame')))
+        self.conn.executemany(
+            "INSERT INTO messages (entry_id, idx, role, value) VALUES (?, ?, ?, ?)",
+            [(entry_id, i, msg['from'], msg['value']) for i, msg in enumerate(entry['conversations'])])
+        self.conn.executemany(
+            "INSERT INTO boxes (entry_id, message_idx, ref, x1, y1, x2, y2) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(entry_id, i, ref) + box
+             for i, msg in enumerate(entry['conversations']) if msg['from'] == 'assistant'
+             for ref, box in parse_boxes(msg['value'])])
+
+        number = identity_number(entry_id)
+        if number is not None and number >= self.next_id():
+            self._set_meta("next_id", number + 1)
+
+    def _delete(self, entry_id):
+        self.conn.execute("DELETE FROM boxes WHERE entry_id = ?", (entry_id,))
+        self.conn.execute("DELETE FROM messages WHERE entry_id = ?", (entry_id,))
+        self.conn.execute("DELETE FROM entries WHERE id = ?", (entry_id,))
+
+    def has_entry(self, entry_id):
+        return self.conn.execute("SELECT 1 FROM entries WHERE id = ?", (entry_id,)).fetchone() is not None
+
+    def save_entry(self, entry, old_id=None):
+        """Insert a new entry, or replace the entry old_id keeping its list position.
+
+        Raises ValueError if the id is already used by another entry.
+        """
+        with self.conn:
+            if entry['id'] != old_id and self.has_entry(entry['id']):
+                raise ValueError(f"ID {entry['id']} is already used by another entry")
+            row = None
+            if old_id is not None:
+                row = self.conn.execute("SELECT position FROM entries WHERE id = ?", (old_id,)).fetchone()
+            if row:
+                position = row[0]
+                self._delete(old_id)
+            else:
+                position = self._meta("next_position", 0)
+                self._set_meta("next_position", position + 1)
+            self._insert(entry, position)
+            self._set_meta("dirty", 1)
+
+    def delete_entry(self, entry_id):
+        with self.conn:
+            self._delete(entry_id)
+            self._set_meta("dirty", 1)
+
+    def clear(self):
+        with self.conn:
+            for table in ("boxes", "messages", "entries", "meta"):
+                self.conn.execute(f"DELETE FROM {table}")
+
+    def get_entry(self, entry_id):
+        rows = self.conn.execute("SELECT role, value FROM messages WHERE entry_id = ? ORDER BY idx",
+                                 (entry_id,)).fetchall()
+        entry = {"id": entry_id, "conversations": [{"from": role, "value": value} for role, value in rows]}
+        row = self.conn.execute("SELECT box_frame FROM entries WHERE id = ?", (entry_id,)).fetchone()
+        if row and row[0]:
+            entry['box_frame'] = row[0]
+        return entry
+
+    def get_image(self, entry_id):
+        row = self.conn.execute("SELECT image FROM entries WHERE id = ?", (entry_id,)).fetchone()
+        return row[0] if row and row[0] else ""
+
+    def ids(self):
+        """Entry ids in list order"""
+        return [row[0] for row in self.conn.execute("SELECT id FROM entries ORDER BY position")]
+
+    def message_counts(self, entry_ids):
+        """Number of messages of each of the given entries"""
+        if not entry_ids:
+            return {}
+        placeholders = ",".join("?" * len(entry_ids))
+        rows = self.conn.execute(
+            f"SELECT entry_id, COUNT(*) FROM messages WHERE entry_id IN ({placeholders}) GROUP BY entry_id",
+            list(entry_ids))
+        return dict(rows.fetchall())
+
+    def iter_entries(self):
+        """Entries in list order, one at a time"""
+        ids = self.conn.execute("SELECT id FROM entries ORDER BY position")
+        for (entry_id,) in ids:
+            yield self.get_entry(entry_id)
+
+    def import_entries(self, entries):
+        """Replace the store content in a single transaction.
+
+        Ids have to be unique in the store; a repeated id is kept under a new
+        "<id>_dupN" id instead of overwriting the earlier entry. Returns the
+        [(old id, new id)] renames so they can be reported.
+        """
+        renamed = []
+        with self.conn:
+            for table in ("boxes", "messages", "entries", "meta"):
+                self.conn.execute(f"DELETE FROM {table}")
+            position = 0
+            for position, entry in enumerate(entries, 1):
+                if self.has_entry(entry['id']):
+                    n = 2
+                    while self.has_entry(f"{entry['id']}_dup{n}"):
+                        n += 1
+                    new_id = f"{entry['id']}_dup{n}"
+                    renamed.append((entry['id'], new_id))
+                    entry = dict(entry, id=new_id)
+                self._insert(entry, position - 1)
+            self._set_meta("next_position", position)
+        return renamed
+
+    def _record_source(self, path):
+        """Remember the JSON file the store content matches"""
+        stat = os.stat(path)
+        with self.conn:
+            self._set_meta("source_size", stat.st_size)
+            self._set_meta("source_mtime_ns", stat.st_mtime_ns)
+            self._set_meta("dirty", 0)
+
+    def in_sync_with(self, path):
+        """Whether the store holds exactly the content of the JSON file: it was
+        imported from or exported to that file, neither side changed since"""
+        stat = os.stat(path)
+        return (not self._meta("dirty", 1)
+                and self._meta("source_size", None) == stat.st_size
+                and self._meta("source_mtime_ns", None) == stat.st_mtime_ns)
+
+    def import_json(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            renamed = self.import_entries(json.load(f))
+        self._record_source(path)
+        return renamed
+
+    def export_json(self, path):
+        """Stream the entries to a Dataset.json file, formatted like json.dump(..., indent=2)"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("[")
+            for i, entry in enumerate(self.iter_entries()):
+                text = json.dumps(entry, ensure_ascii=False, indent=2)
+                f.write(("," if i else "") + "\n  " + text.replace("\n", "\n  "))
+            f.write("\n]" if self.count() else "]")
+        os.replace(tmp_path, path)
+        self._record_source(path)
+
+    def save_copy(self, path):
+        """Copy the whole store to another database file and switch to it"""
+        target = sqlite3.connect(path)
+        self.conn.backup(target)
+        self.conn.close()
+        self.conn = target
+        self.path = path
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import math
+import os
+import re
+
+# Image reference inside a user message: "Picture 1: <img>image1.png</img>\n..."
+IMG_RE = re.compile(r"<img>(.*?)</img>")
+
+# Grounding answer: "<ref>Поставщик</ref><box>(107,206),(347,226)</box>". A <box>
+# without its own <ref> belongs to the preceding reference, as in Qwen-VL multi-box answers.
+BOX_RE = re.compile(r"(?:<ref>(.*?)</ref>)?<box>\((\d+),(\d+)\),\((\d+),(\d+)\)</box>")
+
+# Frame of the <box> coordinates of an entry. The editor used to draw on a
+# preview scaled down to fit into 800x600 and stored boxes in its pixels
+# ("display", entries without a "box_frame" field); entries annotated since
+# the zoomable viewer are in original image pixels ("box_frame": "image").
+# Answers of the base model use a 0..1000 grid ("norm1000").
+DISPLAY_FRAME = "display"
+IMAGE_FRAME = "image"
+NORM1000_FRAME = "norm1000"
+LEGACY_DISPLAY_SIZE = (800, 600)
+
+JSON_WHITESPACE = " \t\n\r"
+
+
+def load_dataset(path):
+    """Load a Dataset.json-format file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def iter_dataset(path, chunk_size=1 << 16):
+    """Yield the entries of a Dataset.json-format file one at a time.
+
+    The file is read in chunks and entries are decoded with raw_decode as
+    soon as they are complete, so memory does not grow with the file size.
+    Entries must be separated by exactly one comma and nothing but
+    whitespace may follow the closing bracket.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer, pos, offset, eof = "", 0, 0, False
+        # What may come next: "[", an entry or "]" ("first"), an entry ("entry"),
+        # "," or "]" ("separator"), only whitespace ("end")
+        expected = "["
+        while True:
+            while pos < len(buffer) and buffer[pos] in JSON_WHITESPACE:
+                pos += 1
+            if pos == len(buffer) and not eof:
+                buffer, offset, pos = f.read(chunk_size), offset + len(buffer), 0
+                eof = not buffer
+                continue
+            if expected == "end":
+                if pos < len(buffer):
+                    raise ValueError(f"{path}: unexpected data after the JSON array at character {offset + pos}")
+                return
+            if pos == len(buffer):
+                raise ValueError(f"{path}: truncated JSON array")
+
+            c = buffer[pos]
+            if expected == "[":
+                if c != "[":
+                    raise ValueError(f"{path}: expected a JSON array")
+                pos, expected = pos + 1, "first"
+            elif c == "]" and expected in ("first", "separator"):
+                pos, expected = pos + 1, "end"
+            elif expected == "separator":
+                if c != ",":
+                    raise ValueError(f"{path}: expected ',' or ']' at character {offset + pos}")
+                pos, expected = pos + 1, "entry"
+            else:
+                try:
+                    entry, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    end = None
+                # An entry running up to the end of the buffer may continue in the next chunk
+                if end is None or (end == len(buffer) and not eof):
+                    if eof:
+                        raise ValueError(f"{path}: truncated or malformed JSON array at character {offset + pos}")
+                    # Keep only the undecoded text; reading at least as much again keeps large entries linear
+                    chunk = f.read(max(chunk_size, len(buffer) - pos))
+                    eof = not chunk
+                    buffer, offset, pos = buffer[pos:] + chunk, offset + pos, 0
+                    continue
+                yield entry
+                pos, expected = end, "separator"
+
+
+def is_url(path):
+    return path.startswith(("http://", "https://"))
+
+
+def image_digest(path, chunk_size=1 << 20):
+    """SHA-256 of the image file content (of the address itself for URLs)"""
+    digest = hashlib.sha256()
+    if is_url(path):
+        digest.update(path.encode('utf-8'))
+        return digest.hexdigest()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def resolve_image(image_ref, root):
+    """Resolve an image reference stored by basename relative to the dataset folder"""
+    if is_url(image_ref) or os.path.isabs(image_ref):
+        return image_ref
+    return os.path.join(root, image_ref)
+
+
+def resolve_message(text, root):
+    """Rewrite every <img> tag of a message to a path usable by the model"""
+    return IMG_RE.sub(lambda m: f"<img>{resolve_image(m.group(1), root)}</img>", text)
+
+
+def find_image(entry):
+    """Return the first image reference of an entry or an empty string"""
+    for msg in entry['conversations']:
+        if msg['from'] == 'user':
+            match = IMG_RE.search(msg['value'])
+            if match:
+                return match.group(1)
+    return ""
+
+
+def parse_boxes(text):
+    """Return [(ref, (x1, y1, x2, y2)), ...] for every box of an answer"""
+    boxes = []
+    ref = ""
+    for match in BOX_RE.finditer(text):
+        if match.group(1) is not None:
+            ref = match.group(1).strip()
+        boxes.append((ref, tuple(int(v) for v in match.group(2, 3, 4, 5))))
+    return boxes
+
+
+def box_frame(entry):
+    return entry.get('box_frame', DISPLAY_FRAME)
+
+
+def display_size(width, height, max_size=LEGACY_DISPLAY_SIZE):
+    """Size of the editor preview of a width x height image, as computed by PIL's Image.thumbnail"""
+    max_width, max_height = max_size
+    if max_width >= width and max_height >= height:
+        return width, height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if max_width / max_height >= aspect:
+        return round_aspect(max_height * aspect, key=lambda n: abs(aspect - n / max_height)), max_height
+    return max_width, round_aspect(max_width / aspect, key=lambda n: 0 if n == 0 else abs(aspect - max_width / n))
+
+
+def frame_scale(frame, width, height):
+    """(sx, sy) taking box coordinates of a frame to pixels of a width x height image"""
+    if frame == DISPLAY_FRAME:
+        display_width, display_height = display_size(width, height)
+        return width / display_width, height / display_height
+    if frame == NORM1000_FRAME:
+        return width / 1000, height / 1000
+    return 1.0, 1.0
+
+
+def scale_boxes(boxes, sx, sy):
+    """parse_boxes output with the coordinates multiplied by (sx, sy)"""
+    return [(ref, (x1 * sx, y1 * sy, x2 * sx, y2 * sy)) for ref, (x1, y1, x2, y2) in boxes]
+
+
+def image_size(path):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return image.size
+
+
+def rescale_message(text, sx, sy):
+    """Message text with every <box> scaled by (sx, sy) and rounded to whole pixels"""
+    def rescale(match):
+        x1, y1, x2, y2 = (int(v) for v in match.group(2, 3, 4, 5))
+        ref = f"<ref>{match.group(1)}</ref>" if match.group(1) is not None else ""
+        return f"{ref}<box>({round(x1 * sx)},{round(y1 * sy)}),({round(x2 * sx)},{round(y2 * sy)})</box>"
+    return BOX_RE.sub(rescale, text)
+
+
+def latest_images(entry):
+    """Image reference each message refers to: the latest one shown up to it, None before any"""
+    image_ref = None
+    refs = []
+    for msg in entry['conversations']:
+        if msg['from'] == 'user':
+            image_ref = ([m.group(1) for m in IMG_RE.finditer(msg['value'])] or [image_ref])[-1]
+        refs.append(image_ref)
+    return refs
+
+
+def to_image_frame(entry, root):
+    """The entry with every box converted to original image pixels.
+
+    Boxes of an answer refer to the latest image shown before it. Raises
+    OSError when one of those images cannot be opened.
+    """
+    frame = box_frame(entry)
+    if frame == IMAGE_FRAME:
+        return entry
+    conversations = []
+    sizes = {}
+    for msg, image_ref in zip(entry['conversations'], latest_images(entry)):
+        if msg['from'] == 'assistant' and BOX_RE.search(msg['value']):
+            if image_ref is None:
+                raise OSError(f"{entry['id']}: boxes without an image")
+            if image_ref not in sizes:
+                sizes[image_ref] = image_size(resolve_image(image_ref, root))
+            msg = dict(msg, value=rescale_message(msg['value'], *frame_scale(frame, *sizes[image_ref])))
+        conversations.append(msg)
+    return dict(entry, conversations=conversations, box_frame=IMAGE_FRAME)
+
+
+def iter_turns(entries, root):
+    """Yield every user turn of the dataset with its gold history and reference answer.
+
+    The history is built from the annotated answers, so every turn can be
+    answered independently of the others.
+    """
+    for entry in entries:
+        history = []
+        conversations = entry['conversations']
+        for turn, i in enumerate(range(0, len(conversations) - 1, 2)):
+            user_msg, assistant_msg = conversations[i], conversations[i + 1]
+            if user_msg['from'] != 'user' or assistant_msg['from'] != 'assistant':
+                break
+            query = resolve_message(user_msg['value'], root)
+            yield {
+                "id": entry['id'],
+                "turn": turn,
+                "query": query,
+                "history": list(history),
+                "reference": assistant_msg['value'],
+                "box_frame": box_frame(entry),
+            }
+            history.append((query, assistant_msg['value']))
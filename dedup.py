@@ -0,0 +1,194 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from dataset_utils import IMG_RE, is_url, load_dataset, resolve_image
+
+HASH_SIZE = 8
+_DCT_SIZE = HASH_SIZE * 4
+
+# Number of set bits of every byte value
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+
+
+_DCT = _dct_matrix(_DCT_SIZE)
+
+
+def phash(path):
+    """64-bit DCT perceptual hash packed into 8 bytes, None for unreadable files"""
+    try:
+        with Image.open(path) as image:
+            # JPEG can be decoded directly at a fraction of its size
+            image.draft("L", (_DCT_SIZE * 4, _DCT_SIZE * 4))
+            small = image.convert("L").resize((_DCT_SIZE, _DCT_SIZE), Image.Resampling.LANCZOS)
+    except OSError:
+        return None
+    pixels = np.asarray(small, dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    return np.packbits((low > np.median(low)).ravel())
+
+
+class HashIndex:
+    """Perceptual hashes of image files stored as one bit-packed array.
+
+    The index is saved as .npz and reused across runs; only files whose
+    modification time or size changed are hashed again.
+    """
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.paths = []
+        self.stats = np.zeros((0, 2), dtype=np.float64)
+        self.hashes = np.zeros((0, HASH_SIZE * HASH_SIZE // 8), dtype=np.uint8)
+
+        if cache_path and os.path.exists(cache_path):
+            with np.load(cache_path) as data:
+                self.paths = data['paths'].tolist()
+                self.stats = data['stats']
+                self.hashes = data['hashes']
+
+    def update(self, paths, workers=None):
+        """Hash the given files; returns the number of newly hashed ones"""
+        known = {path: i for i, path in enumerate(self.paths)}
+        paths = sorted(set(paths))
+        stats = np.zeros((len(paths), 2), dtype=np.float64)
+        hashes = np.zeros((len(paths), self.hashes.shape[1]), dtype=np.uint8)
+        valid = np.zeros(len(paths), dtype=bool)
+
+        stale = []
+        for i, path in enumerate(paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats[i] = (stat.st_mtime, stat.st_size)
+            j = known.get(path)
+            if j is not None and (self.stats[j] == stats[i]).all():
+                hashes[i] = self.hashes[j]
+                valid[i] = True
+            else:
+                stale.append(i)
+
+        if stale:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for i, value in zip(stale, pool.map(phash, [paths[i] for i in stale], chunksize=16)):
+                    if value is not None:
+                        hashes[i] = value
+                        valid[i] = True
+
+        self.paths = [path for path, ok in zip(paths, valid) if ok]
+        self.stats = stats[valid]
+        self.hashes = hashes[valid]
+        if self.cache_path:
+            tmp_path = self.cache_path + ".tmp.npz"
+            np.savez(tmp_path, paths=np.array(self.paths, dtype=str), stats=self.stats, hashes=self.hashes)
+            os.replace(tmp_path, self.cache_path)
+        return len(stale)
+
+    def near_pairs(self, max_distance=6, block_size=256):
+        """Index pairs (i, j), i < j, whose hashes differ in at most max_distance bits.
+
+        Distances are computed a block of rows at a time as XOR plus a byte
+        popcount table, so memory stays at about block_size * n * 16 bytes.
+        """
+        n = len(self.hashes)
+        pairs = []
+        for start in range(0, n, block_size):
+            block = self.hashes[start:start + block_size]
+            rest = self.hashes[start:]
+            distances = POPCOUNT[block[:, None, :] ^ rest[None, :, :]].sum(axis=2, dtype=np.uint16)
+            rows, cols = np.nonzero(distances <= max_distance)
+            cols += start
+            rows += start
+            keep = rows < cols
+            pairs.append(np.stack([rows[keep], cols[keep]], axis=1))
+        return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+    def clusters(self, max_distance=6, min_size=2):
+        """Groups of near-duplicate images as lists of paths"""
+        parent = np.arange(len(self.paths))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i, j in self.near_pairs(max_distance):
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+
+        groups = {}
+        for i in range(len(self.paths)):
+            groups.setdefault(find(i), []).append(self.paths[i])
+        return [group for group in groups.values() if len(group) >= min_size]
+
+
+def referenced_images(path):
+    """{image path: [entry id, ...]} of a dataset file"""
+    root = os.path.dirname(os.path.abspath(path))
+    images = {}
+    for entry in load_dataset(path):
+        for msg in entry['conversations']:
+            for ref in IMG_RE.findall(msg['value']):
+                if not is_url(ref):
+                    image_path = os.path.abspath(resolve_image(ref, root))
+                    images.setdefault(image_path, []).append(entry['id'])
+    return images
+
+
+def report(index, dataset_paths, max_distance=6):
+    """Near-duplicate clusters with the entries using them, per dataset file"""
+    usage = {path: referenced_images(path) for path in dataset_paths}
+    clusters = []
+    cross_split = 0
+    # Singletons count too: the same file may be used by several entries or splits
+    for group in index.clusters(max_distance, min_size=1):
+        members = []
+        for image_path in group:
+            for dataset_path, images in usage.items():
+                for entry_id in images.get(image_path, []):
+                    members.append({"file": dataset_path, "id": entry_id, "image": image_path})
+        if len(members) < 2:
+            continue
+        files = sorted({member['file'] for member in members})
+        cross_split += len(files) > 1
+        clusters.append({"images": group, "files": files, "entries": members})
+    clusters.sort(key=lambda cluster: (-len(cluster['files']), -len(cluster['images'])))
+    return {"images": len(index.paths), "clusters": len(clusters), "cross_split_clusters": cross_split,
+            "details": clusters}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find near-duplicate images referenced by dataset files")
+    parser.add_argument("paths", nargs="+", help="Dataset.json-format files, e.g. Dataset.json test.json")
+    parser.add_argument("--index", help="Hash index cache (default: .phash_index.npz next to the first file)")
+    parser.add_argument("--max-distance", type=int, default=6, help="Hamming distance of near duplicates")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    index_path = args.index or os.path.join(os.path.dirname(os.path.abspath(args.paths[0])), ".phash_index.npz")
+    index = HashIndex(index_path)
+    images = set()
+    for path in args.paths:
+        images.update(referenced_images(path))
+    index.update(images, args.workers)
+
+    json.dump(report(index, args.paths, args.max_distance), sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+import re
+import tkinter as tk
+
+from dataset_utils import IMG_RE
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return set(TOKEN_RE.findall(text.lower()))
+
+
+class EntrySearchIndex:
+    """Inverted index from words of ids, image names, questions and answers to entry ids"""
+
+    def __init__(self):
+        self.postings = {}
+        self.entry_tokens = {}
+
+    def add(self, entry):
+        self.remove(entry['id'])
+        tokens = tokenize(entry['id']) | {entry['id'].lower()}
+        for msg in entry['conversations']:
+            tokens |= tokenize(msg['value'])
+            # Whole file names, so that "image4.png" is found as typed
+            tokens |= {image.lower() for image in IMG_RE.findall(msg['value'])}
+
+        self.entry_tokens[entry['id']] = tokens
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(entry['id'])
+
+    def remove(self, entry_id):
+        for token in self.entry_tokens.pop(entry_id, ()):
+            ids = self.postings[token]
+            ids.discard(entry_id)
+            if not ids:
+                del self.postings[token]
+
+    def search(self, query):
+        """Ids of the entries containing every word of the query"""
+        # An id or a file name typed as a whole is a token by itself
+        whole = query.strip().lower()
+        if whole in self.postings:
+            return set(self.postings[whole])
+
+        postings = sorted((self.postings.get(token, set()) for token in tokenize(query)), key=len)
+        if not postings:
+            return set()
+        result = set(postings[0])
+        for ids in postings[1:]:
+            result &= ids
+        return result
+
+
+class VirtualEntryList(tk.Frame):
+    """Entries list that only renders the rows in view.
+
+    Row texts are read from the store for the visible window, additions and
+    edits touch only their own row, and the search box jumps to any entry
+    through an inverted index that is built on first use.
+    """
+
+    def __init__(self, parent, store, rows=12):
+        super().__init__(parent)
+        self.store = store
+        self.rows = rows
+        self.ids = []
+        self.first = 0
+        self.selected = None
+        self._positions = None
+        self.index = None
+        self.matches = []
+        self.match_pos = 0
+        self.last_query = None
+
+        # Search box
+        self.search_frame = tk.Frame(self)
+        self.search_frame.pack(fill=tk.X)
+
+        tk.Label(self.search_frame, text="Поиск:").pack(side=tk.LEFT, padx=5)
+        self.search_entry = tk.Entry(self.search_frame)
+        self.search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        self.search_entry.bind("<Return>", self.search)
+        tk.Button(self.search_frame, text="Найти", command=self.search).pack(side=tk.LEFT, padx=5)
+        self.search_status = tk.Label(self.search_frame, text="")
+        self.search_status.pack(side=tk.LEFT, padx=5)
+
+        # Rows
+        self.listbox = tk.Listbox(self, height=rows, exportselection=False)
+        self.scrollbar = tk.Scrollbar(self, command=self.on_scroll)
+
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox.pack(fill=tk.BOTH, expand=True)
+
+        self.listbox.bind("<<ListboxSelect>>", self.on_select)
+        self.listbox.bind("<MouseWheel>", self.on_mouse_wheel)
+
+    def set_store(self, store):
+        """Show the entries of a newly opened store"""
+        self.store = store
+        self.ids = store.ids()
+        self._positions = None
+        self.index = None
+        self.last_query = None
+        self.first = 0
+        self.selected = None
+        self.search_status.config(text="")
+        self.render()
+
+    def position_of(self, entry_id):
+        if self._positions is None:
+            self._positions = {entry_id: i for i, entry_id in enumerate(self.ids)}
+        return self._positions.get(entry_id)
+
+    def selected_id(self):
+        if self.selected is None or self.selected >= len(self.ids):
+            return None
+        return self.ids[self.selected]
+
+    def _row_text(self, entry_id, n_messages):
+        return f"{entry_id} ({n_messages} сообщений)"
+
+    def render(self):
+        """Redraw the visible window of rows"""
+        window = self.ids[self.first:self.first + self.rows]
+        counts = self.store.message_counts(window)
+        self.listbox.delete(0, tk.END)
+        for entry_id in window:
+            self.listbox.insert(tk.END, self._row_text(entry_id, counts.get(entry_id, 0)))
+        if self.selected is not None and self.first <= self.selected < self.first + self.rows:
+            self.listbox.selection_set(self.selected - self.first)
+        self._update_scrollbar()
+
+    def _update_scrollbar(self):
+        if not self.ids:
+            self.scrollbar.set(0, 1)
+            return
+        total = len(self.ids)
+        self.scrollbar.set(self.first / total, min(1.0, (self.first + self.rows) / total))
+
+    def _render_row(self, position):
+        if not self.first <= position < self.first + self.rows:
+            return
+        entry_id = self.ids[position]
+        row = position - self.first
+        self.listbox.delete(row)
+        self.listbox.insert(row, self._row_text(entry_id, self.store.message_counts([entry_id]).get(entry_id, 0)))
+        if self.selected == position:
+            self.listbox.selection_set(row)
+
+    def scroll_to(self, first):
+        first = max(0, min(first, len(self.ids) - self.rows))
+        if first != self.first:
+            self.first = first
+            self.render()
+
+    def show(self, entry_id):
+        """Scroll to an entry and select it"""
+        position = self.position_of(entry_id)
+        if position is None:
+            return
+        self.selected = position
+        self.first = max(0, min(position - self.rows // 2, len(self.ids) - self.rows))
+        self.render()
+
+    def on_scroll(self, *args):
+        if args[0] == "moveto":
+            self.scroll_to(int(float(args[1]) * len(self.ids)))
+        elif args[0] == "scroll":
+            step = self.rows if args[2] == "pages" else 1
+            self.scroll_to(self.first + int(args[1]) * step)
+
+    def on_mouse_wheel(self, event):
+        self.scroll_to(self.first - int(event.delta / 120) * 3)
+        # Keep the main window from scrolling too
+        return "break"
+
+    def on_select(self, event=None):
+        selection = self.listbox.curselection()
+        if selection:
+            self.selected = self.first + selection[0]
+
+    def entry_saved(self, entry, old_id=None):
+        """Reflect an added or edited entry without redrawing the list"""
+        # Matches of the last search may refer to the old id or content
+        self.last_query = None
+        self.matches = []
+        old_id = old_id or entry['id']
+        position = self.position_of(old_id)
+        if position is None:
+            position = self.position_of(entry['id'])
+
+        if position is None:
+            # New entries go to the end, like in the store
+            self.ids.append(entry['id'])
+            self._positions[entry['id']] = len(self.ids) - 1
+            if len(self.ids) - 1 < self.first + self.rows:
+                self.listbox.insert(tk.END, self._row_text(entry['id'], len(entry['conversations'])))
+            self._update_scrollbar()
+        elif entry['id'] == old_id:
+            self._render_row(position)
+        elif self.position_of(entry['id']) is None:
+            # Renamed entry keeps its place
+            self.ids[position] = entry['id']
+            del self._positions[old_id]
+            self._positions[entry['id']] = position
+            self._render_row(position)
+        else:
+            # Renamed onto an existing id, the store replaced that entry
+            self.ids = self.store.ids()
+            self._positions = None
+            self.render()
+
+        if self.index is not None:
+            self.index.remove(old_id)
+            self.index.add(entry)
+
+    def entry_deleted(self, entry_id):
+        self.last_query = None
+        self.matches = []
+        position = self.position_of(entry_id)
+        if position is None:
+            return
+        del self.ids[position]
+        self._positions = None
+        if self.selected is not None:
+            if self.selected == position:
+                self.selected = None
+            elif self.selected > position:
+                self.selected -= 1
+        if self.index is not None:
+            self.index.remove(entry_id)
+        self.first = max(0, min(self.first, len(self.ids) - self.rows))
+        self.render()
+
+    def search(self, event=None):
+        query = self.search_entry.get()
+        if not query.strip():
+            return
+
+        if self.index is None:
+            self.index = EntrySearchIndex()
+            for entry in self.store.iter_entries():
+                self.index.add(entry)
+
+        # Repeating the same query cycles through the matches
+        if query == self.last_query and self.matches:
+            self.match_pos = (self.match_pos + 1) % len(self.matches)
+        else:
+            self.last_query = query
+            self.matches = sorted(self.index.search(query), key=self.position_of)
+            self.match_pos = 0
+
+        if not self.matches:
+            self.search_status.config(text="Не найдено")
+            return
+        self.search_status.config(text=f"{self.match_pos + 1}/{len(self.matches)}")
+        self.show(self.matches[self.match_pos])
@@ -0,0 +1,185 @@
+import argparse
+import json
+
+import numpy as np
+
+from dataset_utils import BOX_RE, iter_turns, load_dataset, parse_boxes
+
+DEFAULT_THRESHOLDS = (0.5, 0.75, 0.9)
+
+
+def levenshtein(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def _flatten(samples, field_ids):
+    """Box arrays with the sample index and field id of every box"""
+    sample_idx, fields, coords = [], [], []
+    for i, boxes in enumerate(samples):
+        for ref, box in boxes:
+            sample_idx.append(i)
+            fields.append(field_ids.setdefault(ref, len(field_ids)))
+            coords.append(box)
+    return (np.array(sample_idx, dtype=np.int64),
+            np.array(fields, dtype=np.int64),
+            np.array(coords, dtype=np.float64).reshape(-1, 4))
+
+
+def _pad(sample_idx, values, n_samples, fill):
+    """Scatter per-box values into a [n_samples, max_boxes, ...] array"""
+    counts = np.bincount(sample_idx, minlength=n_samples)
+    width = max(int(counts.max()) if counts.size else 0, 1)
+    # Position of each box inside its sample; boxes are grouped by sample
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    slot = np.arange(len(sample_idx)) - starts[sample_idx]
+    padded = np.full((n_samples, width) + values.shape[1:], fill, dtype=values.dtype)
+    padded[sample_idx, slot] = values
+    mask = np.zeros((n_samples, width), dtype=bool)
+    mask[sample_idx, slot] = True
+    return padded, mask
+
+
+def iou_matrices(pred, gold):
+    """IoU of every predicted box with every gold box of the same sample.
+
+    pred is [S, P, 4] and gold is [S, G, 4]; the result is [S, P, G].
+    """
+    p = pred[:, :, None, :]
+    g = gold[:, None, :, :]
+    iw = np.clip(np.minimum(p[..., 2], g[..., 2]) - np.maximum(p[..., 0], g[..., 0]), 0, None)
+    ih = np.clip(np.minimum(p[..., 3], g[..., 3]) - np.maximum(p[..., 1], g[..., 1]), 0, None)
+    inter = iw * ih
+    area_p = (p[..., 2] - p[..., 0]).clip(0) * (p[..., 3] - p[..., 1]).clip(0)
+    area_g = (g[..., 2] - g[..., 0]).clip(0) * (g[..., 3] - g[..., 1]).clip(0)
+    union = area_p + area_g - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def greedy_match(iou):
+    """One-to-one matching of predicted and gold boxes by descending IoU.
+
+    iou is [S, P, G] with 0 for pairs that may not match. Every box is used
+    at most once; returns the IoU of the match of every prediction [S, P]
+    and of every gold box [S, G], 0 for unmatched boxes. Greedy matching at
+    descending IoU gives the same matches above any threshold as running it
+    per threshold.
+    """
+    s, p, g = np.nonzero(iou > 0)
+    values = iou[s, p, g]
+    pred_iou = np.zeros(iou.shape[:2])
+    gold_iou = np.zeros((iou.shape[0], iou.shape[2]))
+    for i in np.argsort(-values, kind="stable"):
+        if pred_iou[s[i], p[i]] == 0 and gold_iou[s[i], g[i]] == 0:
+            pred_iou[s[i], p[i]] = gold_iou[s[i], g[i]] = values[i]
+    return pred_iou, gold_iou
+
+
+def match_boxes(pred, gold):
+    """IoU of the matched prediction of every gold box of one sample (0 if unmatched).
+
+    pred and gold are parse_boxes lists; only boxes with the same ref match.
+    """
+    if not pred or not gold:
+        return np.zeros(len(gold))
+    iou = iou_matrices(np.array([[box for _, box in pred]], dtype=np.float64),
+                       np.array([[box for _, box in gold]], dtype=np.float64))
+    same_ref = np.array([[[p == g for g, _ in gold] for p, _ in pred]])
+    return greedy_match(np.where(same_ref, iou, 0.0))[1][0]
+
+
+def evaluate_boxes(predictions, references, thresholds=DEFAULT_THRESHOLDS):
+    """Per-field precision/recall of grounding answers at several IoU thresholds"""
+    field_ids = {}
+    n = len(references)
+    p_idx, p_field, p_box = _flatten([parse_boxes(text) for text in predictions], field_ids)
+    g_idx, g_field, g_box = _flatten([parse_boxes(text) for text in references], field_ids)
+    n_fields = len(field_ids)
+
+    pred, pred_mask = _pad(p_idx, p_box, n, 0.0)
+    gold, gold_mask = _pad(g_idx, g_box, n, 0.0)
+    pred_field, _ = _pad(p_idx, p_field, n, -1)
+    gold_field, _ = _pad(g_idx, g_field, n, -2)
+
+    # Only boxes of the same field can match each other
+    valid = pred_mask[:, :, None] & gold_mask[:, None, :] & (pred_field[:, :, None] == gold_field[:, None, :])
+    iou = np.where(valid, iou_matrices(pred, gold), 0.0)
+    pred_iou, gold_iou = greedy_match(iou)
+
+    pred_total = np.bincount(p_field, minlength=n_fields)
+    gold_total = np.bincount(g_field, minlength=n_fields)
+    names = sorted(field_ids, key=field_ids.get)
+
+    report = {"mean_matched_iou": float(gold_iou[gold_mask].mean()) if gold_mask.any() else None,
+              "fields": {name: {"predicted": int(pred_total[i]), "gold": int(gold_total[i])}
+                         for i, name in enumerate(names)}}
+    for t in thresholds:
+        # A prediction is correct if it is matched to a gold box of its field, duplicates stay unmatched
+        tp_pred = np.bincount(pred_field[pred_mask], weights=(pred_iou >= t)[pred_mask], minlength=n_fields)
+        tp_gold = np.bincount(gold_field[gold_mask], weights=(gold_iou >= t)[gold_mask], minlength=n_fields)
+        for i, name in enumerate(names):
+            report["fields"][name][f"precision@{t}"] = float(tp_pred[i] / pred_total[i]) if pred_total[i] else 0.0
+            report["fields"][name][f"recall@{t}"] = float(tp_gold[i] / gold_total[i]) if gold_total[i] else 0.0
+        report[f"precision@{t}"] = float(tp_pred.sum() / max(pred_total.sum(), 1))
+        report[f"recall@{t}"] = float(tp_gold.sum() / max(gold_total.sum(), 1))
+    return report
+
+
+def evaluate_text(predictions, references):
+    """Exact match and character error rate of free-text answers"""
+    exact = 0
+    errors = chars = 0
+    for prediction, reference in zip(predictions, references):
+        prediction, reference = prediction.strip(), reference.strip()
+        exact += prediction == reference
+        errors += levenshtein(prediction, reference)
+        chars += len(reference)
+    return {
+        "samples": len(references),
+        "exact_match": exact / len(references) if references else None,
+        "cer": errors / chars if chars else None,
+    }
+
+
+def evaluate(records, thresholds=DEFAULT_THRESHOLDS):
+    """Score records with 'response' and 'reference' fields"""
+    grounding = [r for r in records if BOX_RE.search(r['reference'])]
+    text = [r for r in records if not BOX_RE.search(r['reference'])]
+    return {
+        "text": evaluate_text([r['response'] for r in text], [r['reference'] for r in text]),
+        "grounding": evaluate_boxes([r['response'] for r in grounding], [r['reference'] for r in grounding],
+                                    thresholds),
+    }
+
+
+def load_predictions(path, gold_path=None):
+    with open(path, 'r', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if gold_path:
+        gold = {(s['id'], s['turn']): s for s in iter_turns(load_dataset(gold_path), "")}
+        records = [dict(r, reference=gold[(r['id'], r['turn'])]['reference'],
+                        box_frame=gold[(r['id'], r['turn'])]['box_frame'])
+                   for r in records if (r['id'], r['turn']) in gold]
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate text and <ref>/<box> answers")
+    parser.add_argument("predictions", help="JSONL written by batch_inference.py")
+    parser.add_argument("--gold", help="Dataset.json to take the references from instead of the JSONL")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=list(DEFAULT_THRESHOLDS))
+    args = parser.parse_args()
+
+    report = evaluate(load_predictions(args.predictions, args.gold), args.thresholds)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
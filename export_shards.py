@@ -0,0 +1,243 @@
+import argparse
+import io
+import json
+import os
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+
+from dataset_store import DatasetStore
+from dataset_utils import (BOX_RE, IMAGE_FRAME, IMG_RE, box_frame, frame_scale, is_url, iter_dataset, latest_images,
+                           rescale_message, resolve_image)
+
+# Qwen-VL resizes every image to 448x448 before the visual encoder
+MODEL_IMAGE_SIZE = 448
+
+
+def iter_source(path):
+    """Entries of a Dataset.json file or of a JSONDatasetCreator .sqlite store"""
+    if path.endswith(".sqlite"):
+        store = DatasetStore(path)
+        try:
+            yield from store.iter_entries()
+        finally:
+            store.close()
+    else:
+        yield from iter_dataset(path)
+
+
+def _encode(path, max_size):
+    """File bytes, extension and original size of an image, and the factors of its resize to max_size"""
+    ext = os.path.splitext(path)[1].lower() or ".jpg"
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        if not max_size or max(width, height) <= max_size:
+            return data, ext, (width, height), (1.0, 1.0)
+        if image.format == "JPEG":
+            image.draft("RGB", (max_size, max_size))
+        image = image.convert("RGB")
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=92)
+        return out.getvalue(), ".jpg", (width, height), (image.width / width, image.height / height)
+
+
+def build_sample(entry, key, root, max_size=None):
+    """Tar members [(name, bytes)] of one entry: its images and the rewritten conversation.
+
+    Member names start with key, a file-name-safe sample key (entry ids may
+    contain dots or slashes); the entry keeps its own id in the JSON. Image
+    references become member names of the same sample. Boxes are converted
+    to pixels of the stored images, each answer with the size and resize
+    factors of the latest image shown before it. Entries with boxes on
+    images that are not stored (URLs) keep their boxes as they are.
+    """
+    members = []
+    names = {}
+    sizes = {}
+
+    def replace(match):
+        ref = match.group(1)
+        if is_url(ref):
+            return match.group(0)
+        if ref not in names:
+            data, ext, size, factors = _encode(resolve_image(ref, root), max_size)
+            names[ref] = f"{key}.{len(names)}{ext}"
+            sizes[ref] = size, factors
+            members.append((names[ref], data))
+        return f"<img>{names[ref]}</img>"
+
+    conversations = [dict(msg, value=IMG_RE.sub(replace, msg['value'])) for msg in entry['conversations']]
+
+    frame = box_frame(entry)
+    image_refs = latest_images(entry)
+    boxed = [i for i, msg in enumerate(conversations) if msg['from'] == 'assistant' and BOX_RE.search(msg['value'])]
+    if all(image_refs[i] in sizes for i in boxed):
+        for i in boxed:
+            (width, height), (rx, ry) = sizes[image_refs[i]]
+            sx, sy = frame_scale(frame, width, height)
+            conversations[i] = dict(conversations[i], value=rescale_message(conversations[i]['value'],
+                                                                            sx * rx, sy * ry))
+        frame = IMAGE_FRAME
+
+    sample = dict(entry, conversations=conversations, box_frame=frame)
+    members.append((f"{key}.json", json.dumps(sample, ensure_ascii=False).encode('utf-8')))
+    return members
+
+
+class ShardWriter:
+    """Writes samples to numbered tar shards of bounded size.
+
+    A shard is written as .tar.tmp and renamed once it is complete, so an
+    export that fails leaves only complete shards behind.
+    """
+
+    def __init__(self, out_dir, max_bytes=256 << 20, max_samples=10000):
+        self.out_dir = out_dir
+        self.max_bytes = max_bytes
+        self.max_samples = max_samples
+        self.shards = []
+        self._tar = None
+        self._bytes = self._samples = 0
+        self._mtime = time.time()
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _open(self):
+        path = os.path.join(self.out_dir, f"shard-{len(self.shards):05d}.tar")
+        self.shards.append(path)
+        self._tar = tarfile.open(path + ".tmp", 'w')
+        self._bytes = self._samples = 0
+
+    def write(self, members):
+        if self._tar is None or self._bytes >= self.max_bytes or self._samples >= self.max_samples:
+            self.close()
+            self._open()
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = self._mtime
+            self._tar.addfile(info, io.BytesIO(data))
+            self._bytes += len(data)
+        self._samples += 1
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+            os.replace(self.shards[-1] + ".tmp", self.shards[-1])
+
+    def abort(self):
+        """Delete the shard being written"""
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+            os.remove(self.shards.pop() + ".tmp")
+
+
+def export(source, out_dir, max_size=None, workers=None, max_bytes=256 << 20):
+    """Write the entries of a dataset as tar shards.
+
+    Entries with an image that cannot be read are skipped. Returns the
+    shard paths and [(entry id, error)] of the skipped entries.
+    """
+    root = os.path.dirname(os.path.abspath(source))
+    writer = ShardWriter(out_dir, max_bytes)
+    skipped = []
+    read_ahead = 4 * (workers or os.cpu_count() or 1)
+
+    def write_next(pending):
+        entry_id, future = pending.popleft()
+        try:
+            members = future.result()
+        except OSError as e:
+            skipped.append((entry_id, str(e)))
+            return
+        writer.write(members)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for index, entry in enumerate(iter_source(source)):
+                pending.append((entry['id'], pool.submit(build_sample, entry, f"{index:08d}", root, max_size)))
+                # Bounded read-ahead keeps shards in dataset order without holding every image
+                if len(pending) >= read_ahead:
+                    write_next(pending)
+            while pending:
+                write_next(pending)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.shards, skipped
+
+
+def _iter_raw(paths):
+    """(key, {extension: bytes}) of every sample, reading shards sequentially"""
+    for path in paths:
+        key, members = None, {}
+        with tarfile.open(path, 'r|') as tar:
+            for info in tar:
+                if not info.isfile():
+                    continue
+                name_key, ext = info.name.split(".", 1)
+                if name_key != key and members:
+                    yield key, members
+                    members = {}
+                key = name_key
+                members[ext] = tar.extractfile(info).read()
+        if members:
+            yield key, members
+
+
+def decode_sample(key, members, decode_images=True):
+    """{"entry": dict, "images": {member name: PIL image or bytes}}"""
+    entry = json.loads(members.pop("json"))
+    images = {}
+    for ext, data in members.items():
+        name = f"{key}.{ext}"
+        if decode_images:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+            images[name] = image
+        else:
+            images[name] = data
+    return {"entry": entry, "images": images}
+
+
+def iter_shards(paths, workers=4, decode_images=True):
+    """Stream samples from tar shards in order, decoding images on a thread pool"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for key, members in _iter_raw(paths):
+            pending.append(pool.submit(decode_sample, key, members, decode_images))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a dataset as tar shards with embedded images")
+    parser.add_argument("source", help="Dataset.json-format file or JSONDatasetCreator .sqlite store")
+    parser.add_argument("out_dir", help="Directory of the shards")
+    parser.add_argument("--max-size", type=int, nargs="?", const=MODEL_IMAGE_SIZE,
+                        help=f"Downscale images to this longest side (default without value: {MODEL_IMAGE_SIZE})")
+    parser.add_argument("--shard-mb", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    shards, skipped = export(args.source, args.out_dir, args.max_size, args.workers, args.shard_mb << 20)
+    for entry_id, error in skipped:
+        print(f"Skipped {entry_id}: {error}")
+    print(f"{len(shards)} shards in {time.perf_counter() - start:.1f}s, {len(skipped)} entries skipped")
+
+
+if __name__ == "__main__":
+    main()
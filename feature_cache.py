@@ -0,0 +1,128 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from dataset_utils import image_digest
+
+
+def model_revision(model):
+    config = model.config
+    return f"{config._name_or_path}@{getattr(config, '_commit_hash', None) or ''}"
+
+
+def _to_numpy(tensor):
+    # numpy has no bfloat16, keep the raw bits instead
+    tensor = tensor.detach().cpu()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy()
+
+
+def _from_numpy(array, dtype):
+    tensor = torch.from_numpy(np.array(array))
+    if dtype == torch.bfloat16:
+        tensor = tensor.view(torch.bfloat16)
+    return tensor.to(dtype)
+
+
+class VisualFeatureCache:
+    """On-disk cache of visual encoder outputs with size-based LRU eviction.
+
+    Every image is stored as a separate .npy file and read back memory-mapped,
+    so only the features of the requested images are paged in.
+    """
+
+    def __init__(self, root, max_bytes=2 << 30, revision=""):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.revision = revision
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+
+        # Restore the LRU order of a previous run from file modification times
+        files = []
+        for name in os.listdir(root):
+            if name.endswith(".npy"):
+                stat = os.stat(os.path.join(root, name))
+                files.append((stat.st_mtime, name[:-4], stat.st_size))
+        self._sizes = OrderedDict((key, size) for _, key, size in sorted(files))
+        self.total_bytes = sum(self._sizes.values())
+
+    def _path(self, key):
+        return os.path.join(self.root, key + ".npy")
+
+    def key(self, image_path, dtype):
+        try:
+            digest = image_digest(image_path)
+        except OSError:
+            return None
+        return hashlib.sha256(f"{digest}:{self.revision}:{dtype}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._sizes:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._sizes.move_to_end(key)
+        path = self._path(key)
+        os.utime(path)
+        return np.load(path, mmap_mode='r')
+
+    def put(self, key, array):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.total_bytes -= self._sizes.pop(key, 0)
+            self._sizes[key] = os.path.getsize(path)
+            self.total_bytes += self._sizes[key]
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self._sizes) > 1:
+            key, size = self._sizes.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._sizes), "bytes": self.total_bytes}
+
+    def install(self, model):
+        """Route model.chat image encoding through the cache"""
+        visual = model.transformer.visual
+        encode = visual.encode
+
+        def cached_encode(image_paths):
+            param = next(visual.parameters())
+            keys = [self.key(path, param.dtype) for path in image_paths]
+            features = [self.get(key) if key else None for key in keys]
+
+            missing = [i for i, feature in enumerate(features) if feature is None]
+            if missing:
+                encoded = encode([image_paths[i] for i in missing])
+                for i, feature in zip(missing, encoded):
+                    if keys[i]:
+                        self.put(keys[i], _to_numpy(feature))
+                    features[i] = feature
+
+            return torch.stack([
+                feature if torch.is_tensor(feature) else _from_numpy(feature, param.dtype)
+                for feature in features
+            ]).to(param.device)
+
+        visual.encode = cached_encode
+        return model
@@ -0,0 +1,106 @@
+import argparse
+import os
+
+import torch
+from transformers import AutoModelForCausalLM, Trainer, TrainingArguments
+
+from pretokenize import PackedAttention, PackedDataset, preprocess
+from qwen_utils import INT4_MODEL, load_tokenizer
+
+# Modules finetune.py of Qwen-VL adapts with LoRA
+LORA_TARGET_MODULES = ["c_attn", "attn.c_proj", "w1", "w2"]
+
+
+def load_trainable_model(model_name_or_path, use_lora=True, lora_r=64, lora_alpha=16, lora_dropout=0.05):
+    """Load Qwen-VL for training the way finetune.py does: frozen ViT, Q-LoRA on GPTQ checkpoints.
+
+    PackedAttention is installed on the base model, so segment_ids pass
+    through the PEFT wrapper to it.
+    """
+    quantized = "int4" in model_name_or_path.lower()
+    if quantized and not use_lora:
+        raise ValueError("GPTQ int4 checkpoints can only be trained with LoRA (Q-LoRA)")
+    kwargs = {}
+    if quantized:
+        from transformers import GPTQConfig
+        kwargs["quantization_config"] = GPTQConfig(bits=4, disable_exllama=True)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name_or_path, device_map="auto", trust_remote_code=True, **kwargs)
+    model.config.use_cache = False
+
+    # finetune.py trains the cross-attention resampler but not the ViT itself
+    model.transformer.visual.requires_grad_(False)
+    if hasattr(model.transformer.visual, "attn_pool"):
+        model.transformer.visual.attn_pool.requires_grad_(True)
+
+    packed = PackedAttention(model)
+    if use_lora:
+        from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+
+        if quantized:
+            model = prepare_model_for_kbit_training(model, use_gradient_checkpointing=True)
+        model = get_peft_model(model, LoraConfig(
+            r=lora_r, lora_alpha=lora_alpha, target_modules=LORA_TARGET_MODULES, lora_dropout=lora_dropout,
+            bias="none", task_type="CAUSAL_LM"))
+        # Gradient checkpointing needs inputs that require grad when the embeddings are frozen
+        model.enable_input_require_grads()
+    return model, packed
+
+
+def train(data_path, output_dir, packed_dir=None, model_name_or_path=INT4_MODEL, max_len=2048, use_lora=True,
+          lora_r=64, lora_alpha=16, **training_kwargs):
+    """Fine-tune on packed rows of a Dataset.json file; returns the Trainer.
+
+    The pre-tokenized shards are (re)built in packed_dir when the data file
+    or max_len changed.
+    """
+    tokenizer = load_tokenizer()
+    tokenizer.pad_token_id = tokenizer.eod_id
+    packed_dir = packed_dir or os.path.splitext(data_path)[0] + ".packed"
+    preprocess(data_path, packed_dir, tokenizer, max_len=max_len)
+    dataset = PackedDataset(packed_dir, max_len, pad_token_id=tokenizer.eod_id)
+
+    model, packed = load_trainable_model(model_name_or_path, use_lora, lora_r, lora_alpha)
+    args = TrainingArguments(
+        output_dir=output_dir,
+        # segment_ids are not a parameter of the original forward, keep every column
+        remove_unused_columns=False,
+        gradient_checkpointing=True,
+        bf16=torch.cuda.is_available() and torch.cuda.is_bf16_supported(),
+        report_to="none",
+        **training_kwargs,
+    )
+    trainer = Trainer(model=model, args=args, train_dataset=dataset, tokenizer=tokenizer)
+    trainer.train()
+    trainer.save_state()
+    trainer.save_model(output_dir)
+    packed.remove()
+    return trainer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LoRA fine-tuning of Qwen-VL on packed, pre-tokenized rows")
+    parser.add_argument("--model_name_or_path", default=INT4_MODEL)
+    parser.add_argument("--data_path", required=True, help="Dataset.json-format input")
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--packed_dir", help="Pre-tokenized shards (default: <data_path>.packed)")
+    parser.add_argument("--model_max_length", type=int, default=2048, help="Packed row length")
+    parser.add_argument("--use_lora", action="store_true")
+    parser.add_argument("--lora_r", type=int, default=64)
+    parser.add_argument("--lora_alpha", type=int, default=16)
+    parser.add_argument("--per_device_train_batch_size", type=int, default=1)
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=8)
+    parser.add_argument("--num_train_epochs", type=float, default=5)
+    parser.add_argument("--learning_rate", type=float, default=1e-5)
+    args = parser.parse_args()
+
+    train(args.data_path, args.output_dir, args.packed_dir, args.model_name_or_path, args.model_max_length,
+          args.use_lora, args.lora_r, args.lora_alpha,
+          per_device_train_batch_size=args.per_device_train_batch_size,
+          gradient_accumulation_steps=args.gradient_accumulation_steps,
+          num_train_epochs=args.num_train_epochs,
+          learning_rate=args.learning_rate)
+
+
+if __name__ == "__main__":
+    main()
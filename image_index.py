@@ -0,0 +1,81 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from dataset_utils import image_digest
+from image_loader import IMAGE_EXTENSIONS
+
+
+def describe_image(path):
+    """Dimensions and content hash of an image file"""
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+        return {"width": width, "height": height, "sha256": image_digest(path)}
+    except OSError as e:
+        return {"error": str(e)}
+
+
+def iter_image_files(roots):
+    for root in roots:
+        for folder, _, names in os.walk(root):
+            for name in names:
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.abspath(os.path.join(folder, name))
+
+
+class ImageIndex:
+    """Metadata of every image under the dataset roots.
+
+    The index is cached in a JSON file and refreshed incrementally: only
+    files whose modification time or size changed are opened again, in a
+    process pool.
+    """
+
+    def __init__(self, roots, cache_path=None):
+        self.roots = roots
+        self.cache_path = cache_path
+        self.images = {}
+        self.by_name = {}
+
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                self.images = json.load(f)
+
+    def update(self, workers=None, describe=describe_image):
+        """Rescan the roots; returns the number of (re)described images"""
+        found = {}
+        for path in iter_image_files(self.roots):
+            stat = os.stat(path)
+            found[path] = (stat.st_mtime, stat.st_size)
+
+        stale = [
+            path for path, (mtime, size) in found.items()
+            if path not in self.images or (self.images[path]['mtime'], self.images[path]['size']) != (mtime, size)
+        ]
+        removed = [path for path in self.images if path not in found]
+        for path in removed:
+            del self.images[path]
+
+        if stale:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for path, info in zip(stale, pool.map(describe, stale, chunksize=32)):
+                    mtime, size = found[path]
+                    self.images[path] = dict(info, mtime=mtime, size=size)
+
+        if (stale or removed) and self.cache_path:
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.images, f)
+            os.replace(tmp_path, self.cache_path)
+
+        self.by_name = {}
+        for path, info in self.images.items():
+            self.by_name.setdefault(os.path.basename(path), []).append(dict(info, path=path))
+        return len(stale)
+
+    def lookup(self, image_ref):
+        """Index entries of the images an image reference may point to"""
+        return self.by_name.get(os.path.basename(image_ref), [])
@@ -0,0 +1,87 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def image_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+def decode_image(path, max_size):
+    """Decode an image scaled down to fit max_size"""
+    image = Image.open(path)
+    # JPEG can be decoded directly at 1/2, 1/4 or 1/8 scale
+    if image.format == "JPEG":
+        image.draft("RGB", max_size)
+    if image.width > max_size[0] or image.height > max_size[1]:
+        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+    else:
+        image.load()
+    return image
+
+
+def list_folder_images(folder):
+    return sorted(
+        os.path.join(folder, name) for name in os.listdir(folder)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+class ImageLoader:
+    """Decodes display images on a worker pool and keeps them in an LRU cache.
+
+    The cache is bounded by the decoded size of the images, and entries are
+    keyed by path and modification time so edited files are decoded again.
+    """
+
+    def __init__(self, max_size=(800, 600), max_bytes=256 << 20, workers=2):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _key(self, path):
+        return path, os.path.getmtime(path)
+
+    def request(self, path):
+        """Future of the decoded image, already resolved when it is cached"""
+        key = self._key(path)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                future = Future()
+                future.set_result(self._cache[key])
+                return future
+            if key in self._pending:
+                return self._pending[key]
+            future = self.executor.submit(decode_image, path, self.max_size)
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._store(key, f))
+        return future
+
+    def prefetch(self, paths):
+        for path in paths:
+            try:
+                self.request(path)
+            except OSError:
+                pass
+
+    def _store(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+            if future.exception() is not None:
+                return
+            image = future.result()
+            self._cache[key] = image
+            self.total_bytes += image_bytes(image)
+            while self.total_bytes > self.max_bytes and len(self._cache) > 1:
+                _, old_image = self._cache.popitem(last=False)
+                self.total_bytes -= image_bytes(old_image)
@@ -0,0 +1,92 @@
+import argparse
+import threading
+from contextlib import contextmanager
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers.generation import GenerationConfig
+
+from qwen_utils import BASE_MODEL
+
+
+def merge_adapter(adapter_path, output_path, base_model=BASE_MODEL, dtype=torch.bfloat16):
+    """Fold a LoRA adapter into the base weights and save a plain checkpoint.
+
+    GPTQ int4 weights cannot absorb the LoRA delta, so an adapter trained on
+    Qwen-VL-Chat-Int4 (Q-LoRA, as in the notebook) is merged into the
+    floating-point Qwen-VL-Chat it was quantized from.
+    """
+    from peft import PeftModel
+
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model, torch_dtype=dtype, device_map="cpu", trust_remote_code=True)
+    model = PeftModel.from_pretrained(model, adapter_path).merge_and_unload()
+    model.save_pretrained(output_path, safe_serialization=True, max_shard_size="2GB")
+    AutoTokenizer.from_pretrained(base_model, trust_remote_code=True).save_pretrained(output_path)
+    return output_path
+
+
+def load_merged(path, device_map="auto"):
+    """Load a checkpoint written by merge_adapter like load_model does"""
+    model = AutoModelForCausalLM.from_pretrained(path, device_map=device_map, trust_remote_code=True).eval()
+    model.generation_config = GenerationConfig.from_pretrained(BASE_MODEL, trust_remote_code=True)
+    return model
+
+
+class AdapterPool:
+    """Several LoRA adapters on one base model, switched per batch.
+
+    All adapters are loaded once; use(name) activates one for the duration of
+    a block (None runs the plain base model). Switching only changes which
+    adapter weights the LoRA layers read, nothing is reloaded.
+    """
+
+    def __init__(self, model, adapters):
+        from peft import PeftModel
+
+        names = list(adapters)
+        self.model = PeftModel.from_pretrained(model, adapters[names[0]], adapter_name=names[0])
+        for name in names[1:]:
+            self.model.load_adapter(adapters[name], adapter_name=name)
+        self.model.eval()
+        self.names = set(names)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def use(self, name):
+        with self._lock:
+            if name is None:
+                with self.model.disable_adapter():
+                    yield self.model
+            else:
+                if name not in self.names:
+                    raise KeyError(f"unknown adapter {name!r}")
+                self.model.set_adapter(name)
+                yield self.model
+
+
+def parse_adapters(specs):
+    """{name: path} from NAME=PATH arguments"""
+    adapters = {}
+    for spec in specs:
+        name, sep, path = spec.partition("=")
+        if not sep or not name or not path:
+            raise argparse.ArgumentTypeError(f"expected NAME=PATH, got {spec!r}")
+        adapters[name] = path
+    return adapters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge a LoRA adapter into Qwen-VL-Chat")
+    parser.add_argument("adapter_path", help="Adapter directory, e.g. ./suppliers_lora")
+    parser.add_argument("output_path", help="Directory of the merged checkpoint")
+    parser.add_argument("--base-model", default=BASE_MODEL)
+    parser.add_argument("--dtype", choices=("bf16", "fp16", "fp32"), default="bf16")
+    args = parser.parse_args()
+
+    dtype = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}[args.dtype]
+    print(merge_adapter(args.adapter_path, args.output_path, args.base_model, dtype))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,26 @@
-import json
+import functools
 import os
+import time
 import tkinter as tk
-from tkinter import filedialog, messagebox
-from PIL import Image, ImageTk
+from tkinter import filedialog, messagebox, simpledialog
+
+from dataset_store import DatasetStore
+from dataset_utils import IMAGE_FRAME, to_image_frame
+from entry_list import VirtualEntryList
+from image_loader import ImageLoader, list_folder_images
+from preannotate import DEFAULT_FIELDS, PreannotationClient
+from tiled_viewer import TiledImageView, TilePyramid
+
+
+def timed_render(method):
+    """Report how long a view update took through the owner's report_render_time"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = method(self, *args, **kwargs)
+        self.report_render_time(method.__name__, time.perf_counter() - start)
+        return result
+    return wrapper
 
 
 class BoundingBoxApp:
@@ -12,15 +30,29 @@ class BoundingBoxApp:
         # Variables for image handling
         self.image_path = ""
         self.image = None
-        self.tk_image = None
-        self.canvas_image = None
 
-        # Variables for bounding box drawing
+        # Images are decoded in the background and cached
+        self.loader = ImageLoader()
+        self.prefetch_count = 2
+
+        # Called with the path of an image opened through next/previous navigation
+        self.on_navigate = None
+        # Called with the path of every image once it is displayed
+        self.on_image_shown = None
+
+        # Model box proposals for the current image: [{"description", "coords"}, ...]
+        self.proposals = []
+
+        # Variables for bounding box drawing, coordinates are in original image pixels
         self.start_x = None
         self.start_y = None
         self.rect = None
+        self.rect_coords = None
         self.bboxes = []
 
+        # Called with (event name, seconds) after every canvas update
+        self.on_render = None
+
         # Main frames
         self.main_frame = tk.Frame(parent)
         self.main_frame.pack(fill=tk.BOTH, expand=True)
@@ -29,9 +61,12 @@ class BoundingBoxApp:
         self.image_frame = tk.LabelFrame(self.main_frame, text="Изображение", padx=5, pady=5)
         self.image_frame.pack(fill=tk.BOTH, expand=True)
 
-        self.canvas = tk.Canvas(self.image_frame, bg="gray", cursor="cross")
+        self.canvas = tk.Canvas(self.image_frame, bg="gray", cursor="cross", width=800, height=600)
         self.canvas.pack(fill=tk.BOTH, expand=True)
 
+        # Mouse wheel zooms, right button drag pans
+        self.view = TiledImageView(self.canvas, on_change=self.on_view_changed)
+
         # Control frame
         self.control_frame = tk.LabelFrame(self.main_frame, text="Управление разметкой", padx=5, pady=5)
         self.control_frame.pack(fill=tk.X)
@@ -42,6 +77,11 @@ class BoundingBoxApp:
         tk.Button(self.control_frame, text="Удалить последнюю", command=self.remove_last_bbox).pack(side=tk.LEFT,
                                                                                                     padx=5)
         tk.Button(self.control_frame, text="Очистить все", command=self.clear_bboxes).pack(side=tk.LEFT, padx=5)
+        tk.Button(self.control_frame, text="Принять предложения",
+                  command=self.accept_all_proposals).pack(side=tk.LEFT, padx=5)
+        tk.Button(self.control_frame, text="След. ▶", command=self.next_image).pack(side=tk.RIGHT, padx=5)
+        tk.Button(self.control_frame, text="Вписать", command=self.view.fit).pack(side=tk.RIGHT, padx=5)
+        tk.Button(self.control_frame, text="◀ Пред.", command=self.previous_image).pack(side=tk.RIGHT, padx=5)
 
         # Object description and bbox list
         self.bbox_list_frame = tk.LabelFrame(self.main_frame, text="Список разметки", padx=5, pady=5)
@@ -59,67 +99,124 @@ class BoundingBoxApp:
         self.canvas.bind("<B1-Motion>", self.on_mouse_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_mouse_release)
 
+        # Double click on a proposal turns it into a bounding box
+        self.canvas.tag_bind("proposal", "<Double-Button-1>", self.accept_proposal)
+
     def load_image(self, file_path=None):
         if not file_path:
             file_path = filedialog.askopenfilename(filetypes=[("Image files", "*.jpg *.jpeg *.png")])
 
         if file_path:
             self.image_path = file_path
-            self.image = Image.open(file_path)
 
-            # Scale down large images
-            max_size = (800, 600)
-            if self.image.width > max_size[0] or self.image.height > max_size[1]:
-                self.image.thumbnail(max_size, Image.Resampling.LANCZOS)
+            # Clear existing bounding boxes
+            self.clear_bboxes()
+            self.set_proposals([])
 
-            self.tk_image = ImageTk.PhotoImage(self.image)
+            # Decoding and scaling down happen on the loader threads
+            self.wait_for_image(file_path, self.loader.request(file_path))
+            self.prefetch_neighbors(file_path)
 
-            # Clear canvas and display image
-            self.canvas.delete("all")
-            self.canvas_image = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
+    def wait_for_image(self, file_path, future):
+        if file_path != self.image_path:
+            # Another image was requested meanwhile
+            return
+        if not future.done():
+            self.canvas.after(15, self.wait_for_image, file_path, future)
+            return
+        if future.exception() is not None:
+            messagebox.showerror("Ошибка", f"Не удалось открыть изображение:\n{future.exception()}")
+            return
+        self.show_image(file_path, future.result())
 
-            # Set canvas size to image size
-            self.canvas.config(width=self.tk_image.width(), height=self.tk_image.height())
+    def show_image(self, file_path, preview):
+        # The preview is the coarsest level, tiles of finer levels are decoded on demand
+        self.image = preview
+        self.view.set_pyramid(TilePyramid(file_path, preview, self.loader.executor))
+        if self.on_image_shown:
+            self.on_image_shown(file_path)
 
-            # Clear existing bounding boxes
-            self.clear_bboxes()
+    def on_view_changed(self):
+        """Move boxes and the current selection after a zoom or pan"""
+        self.redraw_bboxes()
+        self.draw_proposals()
+        if self.rect:
+            self.canvas.coords(self.rect, *self.to_canvas(self.rect_coords))
+
+    def to_canvas(self, coords):
+        x1, y1, x2, y2 = coords
+        return self.view.image_to_canvas(x1, y1) + self.view.image_to_canvas(x2, y2)
+
+    def folder_neighbors(self, file_path):
+        """Images of the folder of file_path and the index of file_path among them"""
+        folder = os.path.dirname(os.path.abspath(file_path))
+        images = list_folder_images(folder)
+        path = os.path.join(folder, os.path.basename(file_path))
+        return images, images.index(path) if path in images else None
+
+    def prefetch_neighbors(self, file_path):
+        if file_path.startswith(("http://", "https://")):
+            return
+        images, index = self.folder_neighbors(file_path)
+        if index is None:
+            return
+        neighbors = []
+        for offset in range(1, self.prefetch_count + 1):
+            for i in (index + offset, index - offset):
+                if 0 <= i < len(images):
+                    neighbors.append(images[i])
+        self.loader.prefetch(neighbors)
+
+    def navigate(self, step):
+        if not self.image_path or self.image_path.startswith(("http://", "https://")):
+            return
+        images, index = self.folder_neighbors(self.image_path)
+        if index is None or not 0 <= index + step < len(images):
+            return
+        self.load_image(images[index + step])
+        if self.on_navigate:
+            self.on_navigate(self.image_path)
+
+    def next_image(self):
+        self.navigate(1)
+
+    def previous_image(self):
+        self.navigate(-1)
 
     def on_mouse_press(self, event):
         # Remove previous temporary rectangle
         if self.rect:
             self.canvas.delete(self.rect)
 
-        self.start_x = event.x
-        self.start_y = event.y
+        self.start_x, self.start_y = self.view.canvas_to_image(event.x, event.y)
+        self.rect_coords = (self.start_x, self.start_y, self.start_x, self.start_y)
 
         # Create new rectangle
         self.rect = self.canvas.create_rectangle(
-            self.start_x, self.start_y,
-            self.start_x, self.start_y,
+            event.x, event.y,
+            event.x, event.y,
             outline="red", width=2, tags="temp_rect"
         )
 
     def on_mouse_drag(self, event):
         # Update rectangle coordinates
         if self.rect:
-            self.canvas.coords(
-                self.rect,
-                self.start_x, self.start_y,
-                event.x, event.y
-            )
+            self.rect_coords = (self.start_x, self.start_y) + self.view.canvas_to_image(event.x, event.y)
+            self.canvas.coords(self.rect, *self.to_canvas(self.rect_coords))
 
     def on_mouse_release(self, event):
         if not self.rect:
             return
 
-        # Check if rectangle is large enough
-        if abs(event.x - self.start_x) < 5 or abs(event.y - self.start_y) < 5:
+        # Check if rectangle is large enough on screen
+        x1, y1, x2, y2 = self.canvas.coords(self.rect)
+        if abs(x2 - x1) < 5 or abs(y2 - y1) < 5:
             self.canvas.delete(self.rect)
             self.rect = None
             return
 
     def add_bbox(self):
-        if not self.rect:
+        if not self.rect or not self.view.pyramid:
             messagebox.showwarning("Предупреждение", "Сначала выделите область на изображении!")
             return
 
@@ -128,9 +225,16 @@ class BoundingBoxApp:
             messagebox.showwarning("Предупреждение", "Введите описание объекта!")
             return
 
-        # Get rectangle coordinates
-        coords = self.canvas.coords(self.rect)
-        x1, y1, x2, y2 = coords
+        # Get rectangle coordinates in original image pixels, clamped to the image
+        x1, y1, x2, y2 = self.rect_coords
+        width, height = self.view.pyramid.width, self.view.pyramid.height
+        x1, x2 = sorted(min(max(int(x), 0), width) for x in (x1, x2))
+        y1, y2 = sorted(min(max(int(y), 0), height) for y in (y1, y2))
+        if x1 == x2 or y1 == y2:
+            messagebox.showwarning("Предупреждение", "Область находится за пределами изображения!")
+            self.canvas.delete(self.rect)
+            self.rect = None
+            return
 
         # Add to list
         bbox_data = {
@@ -142,8 +246,8 @@ class BoundingBoxApp:
         # Add to listbox
         self.bbox_list.insert(tk.END, f"{description}: ({int(x1)},{int(y1)})-({int(x2)},{int(y2)})")
 
-        # Redraw permanent bounding boxes
-        self.redraw_bboxes()
+        # Draw only the new permanent bounding box
+        self.draw_bbox(bbox_data)
 
         # Remove temporary rectangle
         self.canvas.delete(self.rect)
@@ -152,9 +256,9 @@ class BoundingBoxApp:
 
     def remove_last_bbox(self):
         if self.bboxes:
-            self.bboxes.pop()
+            bbox = self.bboxes.pop()
             self.bbox_list.delete(self.bbox_list.size() - 1)
-            self.redraw_bboxes()
+            self.erase_bbox(bbox)
 
     def clear_bboxes(self):
         self.bboxes = []
@@ -164,15 +268,76 @@ class BoundingBoxApp:
             self.canvas.delete(self.rect)
             self.rect = None
 
+    def report_render_time(self, name, seconds):
+        if self.on_render:
+            self.on_render(name, seconds)
+
+    def _create_bbox_items(self, bbox):
+        x1, y1, x2, y2 = self.to_canvas(bbox["coords"])
+        rect = self.canvas.create_rectangle(
+            x1, y1, x2, y2,
+            outline="red", width=2,
+            tags="bbox"
+        )
+        label = self.canvas.create_text(
+            min(x1, x2), min(y1, y2) - 2,
+            text=bbox["description"], anchor=tk.SW, fill="red",
+            tags="bbox"
+        )
+        bbox["items"] = (rect, label)
+
+    @timed_render
+    def draw_bbox(self, bbox):
+        """Add the canvas items of one bounding box"""
+        self._create_bbox_items(bbox)
+
+    @timed_render
+    def erase_bbox(self, bbox):
+        """Remove the canvas items of one bounding box"""
+        for item in bbox.pop("items", ()):
+            self.canvas.delete(item)
+
+    def set_proposals(self, proposals):
+        self.proposals = [dict(proposal) for proposal in proposals]
+        self.draw_proposals()
+
+    def draw_proposals(self):
+        self.canvas.delete("proposal")
+        for i, proposal in enumerate(self.proposals):
+            x1, y1, x2, y2 = self.to_canvas(proposal["coords"])
+            tags = ("proposal", f"proposal_{i}")
+            self.canvas.create_rectangle(x1, y1, x2, y2, outline="orange", width=2, dash=(4, 2), tags=tags)
+            self.canvas.create_text(min(x1, x2), min(y1, y2) - 2, text=proposal["description"],
+                                    anchor=tk.SW, fill="orange", tags=tags)
+
+    def _add_proposal_bbox(self, proposal):
+        x1, y1, x2, y2 = proposal["coords"]
+        bbox_data = {
+            "coords": (x1, y1, x2, y2),
+            "description": proposal["description"]
+        }
+        self.bboxes.append(bbox_data)
+        self.bbox_list.insert(tk.END, f"{bbox_data['description']}: ({int(x1)},{int(y1)})-({int(x2)},{int(y2)})")
+        self.draw_bbox(bbox_data)
+
+    def accept_proposal(self, event=None):
+        """Move the proposal under the cursor to the bounding boxes"""
+        for tag in self.canvas.gettags("current"):
+            if tag.startswith("proposal_"):
+                self._add_proposal_bbox(self.proposals.pop(int(tag.split("_")[1])))
+                self.draw_proposals()
+                return
+
+    def accept_all_proposals(self):
+        for proposal in self.proposals:
+            self._add_proposal_bbox(proposal)
+        self.set_proposals([])
+
+    @timed_render
     def redraw_bboxes(self):
         self.canvas.delete("bbox")
         for bbox in self.bboxes:
-            x1, y1, x2, y2 = bbox["coords"]
-            self.canvas.create_rectangle(
-                x1, y1, x2, y2,
-                outline="red", width=2,
-                tags="bbox"
-            )
+            self._create_bbox_items(bbox)
 
 
 class JSONDatasetCreator:
@@ -181,11 +346,15 @@ class JSONDatasetCreator:
         self.root.title("Создатель JSON датасета с визуальной разметкой")
         self.root.state('zoomed')  # Fullscreen mode
 
-        self.entries = []
+        self.store = DatasetStore()
         self.current_id = 1
         self.current_conversation = []
+        # Number of text lines of every displayed message
+        self.message_lines = []
         self.current_file = None
-        self.editing_index = None
+        self.editing_id = None
+        # Set while editing an entry whose legacy display-pixel boxes could not be converted
+        self.legacy_boxes = False
 
         # Main canvas with scrollbar
         self.main_canvas = tk.Canvas(root)
@@ -218,6 +387,17 @@ class JSONDatasetCreator:
         self.file_menu.add_command(label="Выход", command=root.quit)
         self.menu_bar.add_cascade(label="Файл", menu=self.file_menu)
 
+        # Model-assisted pre-annotation
+        self.preannotator = None
+        self.preannotation_fields = list(DEFAULT_FIELDS)
+        self.preannotate_var = tk.BooleanVar(value=False)
+
+        self.preannotate_menu = tk.Menu(self.menu_bar, tearoff=0)
+        self.preannotate_menu.add_checkbutton(label="Включить предразметку", variable=self.preannotate_var,
+                                              command=self.toggle_preannotation)
+        self.preannotate_menu.add_command(label="Поля предразметки...", command=self.edit_preannotation_fields)
+        self.menu_bar.add_cascade(label="Предразметка", menu=self.preannotate_menu)
+
         root.config(menu=self.menu_bar)
 
         # Image annotation frame
@@ -226,6 +406,9 @@ class JSONDatasetCreator:
 
         # Create annotation app instance
         self.bbox_app = BoundingBoxApp(self.bbox_frame)
+        self.bbox_app.on_render = self.report_render_time
+        self.bbox_app.on_navigate = self.set_image_path
+        self.bbox_app.on_image_shown = self.on_image_shown
 
         # Bind mouse events for annotation canvas
         self.bbox_app.canvas.bind("<ButtonPress-1>", self.bbox_app.on_mouse_press)
@@ -294,15 +477,11 @@ class JSONDatasetCreator:
         self.entries_frame = tk.LabelFrame(self.main_frame, text="Добавленные записи", padx=5, pady=5)
         self.entries_frame.pack(fill=tk.BOTH, expand=True)
 
-        self.entries_listbox = tk.Listbox(self.entries_frame)
-        scrollbar = tk.Scrollbar(self.entries_frame, command=self.entries_listbox.yview)
-        self.entries_listbox.configure(yscrollcommand=scrollbar.set)
-
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.entries_listbox.pack(fill=tk.BOTH, expand=True)
+        self.entries_list = VirtualEntryList(self.entries_frame, self.store)
+        self.entries_list.pack(fill=tk.BOTH, expand=True)
 
         # Bind double click to edit entry
-        self.entries_listbox.bind("<Double-Button-1>", self.edit_selected_entry)
+        self.entries_list.listbox.bind("<Double-Button-1>", self.edit_selected_entry)
 
         # Edit/Delete buttons
         self.edit_frame = tk.Frame(self.entries_frame)
@@ -327,38 +506,94 @@ class JSONDatasetCreator:
         self.clear_btn = tk.Button(self.button_frame, text="Очистить все", command=self.clear_all)
         self.clear_btn.pack(side=tk.RIGHT, padx=5)
 
+        # Cost of the last view update
+        self.render_time_label = tk.Label(self.button_frame, text="", fg="gray")
+        self.render_time_label.pack(side=tk.RIGHT, padx=5)
+
+    def report_render_time(self, name, seconds):
+        self.render_time_label.config(text=f"{name}: {seconds * 1000:.1f} мс")
+
+    def toggle_preannotation(self):
+        if self.preannotate_var.get():
+            cache_path = self.current_file + ".proposals.json" if self.current_file else None
+            self.preannotator = PreannotationClient(self.preannotation_fields, cache_path=cache_path)
+            if self.bbox_app.image_path:
+                self.on_image_shown(self.bbox_app.image_path)
+            self.poll_preannotations()
+        elif self.preannotator:
+            self.preannotator.close()
+            self.preannotator = None
+            self.bbox_app.set_proposals([])
+
+    def edit_preannotation_fields(self):
+        fields = simpledialog.askstring("Предразметка", "Поля через запятую:",
+                                        initialvalue=", ".join(self.preannotation_fields))
+        if fields:
+            self.preannotation_fields = [field.strip() for field in fields.split(",") if field.strip()]
+            if self.preannotator:
+                self.preannotator.fields = tuple(self.preannotation_fields)
+
+    def on_image_shown(self, file_path):
+        """Show cached proposals and queue the current and upcoming images for the model"""
+        if not self.preannotator or file_path.startswith(("http://", "https://")):
+            return
+        proposals = self.preannotator.get(file_path)
+        if proposals is not None:
+            self.bbox_app.set_proposals(proposals)
+        self.preannotator.request(file_path)
+
+        images, index = self.bbox_app.folder_neighbors(file_path)
+        if index is not None:
+            self.preannotator.queue_ahead(images[index + 1:index + 4])
+
+    def poll_preannotations(self):
+        if not self.preannotator:
+            return
+        finished = self.preannotator.poll()
+        current = self.bbox_app.image_path
+        if current and os.path.abspath(current) in finished:
+            self.bbox_app.set_proposals(self.preannotator.get(current))
+        self.root.after(200, self.poll_preannotations)
+
+    def open_store(self, json_path):
+        """Open the SQLite store kept next to a JSON file.
+
+        The store is reused only while it matches the JSON; if the file was
+        changed outside the editor or the store holds edits that were never
+        saved, the JSON is imported again. Returns the renamed duplicate ids.
+        """
+        self.store.close()
+        self.store = DatasetStore(json_path + ".sqlite")
+        if self.store.in_sync_with(json_path):
+            return []
+        return self.store.import_json(json_path)
+
     def load_json(self):
         file_path = filedialog.askopenfilename(filetypes=[("JSON files", "*.json")])
         if file_path:
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    self.entries = json.load(f)
+                renamed = self.open_store(file_path)
                 self.current_file = file_path
 
                 # Update entries list
-                self.update_entries_list()
-
-                # Find max ID to continue numbering
-                max_id = 0
-                for entry in self.entries:
-                    if entry['id'].startswith("identity_"):
-                        try:
-                            current_id = int(entry['id'].split("_")[1])
-                            if current_id > max_id:
-                                max_id = current_id
-                        except:
-                            pass
-
-                self.current_id = max_id + 1
+                self.entries_list.set_store(self.store)
+
+                # Continue numbering after the largest identity_N
+                self.current_id = self.store.next_id()
                 self.id_entry.delete(0, tk.END)
                 self.id_entry.insert(0, f"identity_{self.current_id}")
 
                 messagebox.showinfo("Успех", f"Файл успешно загружен! Текущий ID: {self.current_id}")
+                if renamed:
+                    messagebox.showwarning(
+                        "Повторяющиеся ID",
+                        "Записи с повторяющимися ID сохранены под новыми ID:\n"
+                        + "\n".join(f"{old_id} → {new_id}" for old_id, new_id in renamed))
             except Exception as e:
                 messagebox.showerror("Ошибка", f"Не удалось загрузить файл:\n{str(e)}")
 
     def save_to_json(self):
-        if not self.entries:
+        if not self.store.count():
             messagebox.showwarning("Предупреждение", "Нет данных для сохранения!")
             return
 
@@ -372,14 +607,17 @@ class JSONDatasetCreator:
             self.current_file = file_path
 
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(self.entries, f, ensure_ascii=False, indent=2)
+            # Edits are already stored in the SQLite file, saving exports them as JSON
+            db_path = file_path + ".sqlite"
+            if self.store.path != db_path:
+                self.store.save_copy(db_path)
+            self.store.export_json(file_path)
             messagebox.showinfo("Успех", "Файл успешно сохранен!")
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось сохранить файл:\n{str(e)}")
 
     def save_as_json(self):
-        if not self.entries:
+        if not self.store.count():
             messagebox.showwarning("Предупреждение", "Нет данных для сохранения!")
             return
 
@@ -392,10 +630,13 @@ class JSONDatasetCreator:
     def browse_image(self):
         filename = filedialog.askopenfilename(filetypes=[("Image files", "*.jpg *.jpeg *.png")])
         if filename:
-            self.image_path_entry.delete(0, tk.END)
-            self.image_path_entry.insert(0, filename)
+            self.set_image_path(filename)
             self.bbox_app.load_image(filename)
 
+    def set_image_path(self, file_path):
+        self.image_path_entry.delete(0, tk.END)
+        self.image_path_entry.insert(0, file_path)
+
     def add_qa(self):
         question = self.question_entry.get()
         answer = self.answer_entry.get()
@@ -414,11 +655,10 @@ class JSONDatasetCreator:
         user_msg = f"Picture {self.current_id}: <img>{image_ref}</img>\n{question}"
 
         # Add to conversation
-        self.current_conversation.append({"from": "user", "value": user_msg})
-        self.current_conversation.append({"from": "assistant", "value": answer})
-
-        # Update messages
-        self.update_conversation_display()
+        self.append_messages([
+            {"from": "user", "value": user_msg},
+            {"from": "assistant", "value": answer},
+        ])
 
         # Clear fields
         self.question_entry.delete(0, tk.END)
@@ -429,6 +669,7 @@ class JSONDatasetCreator:
             messagebox.showwarning("Предупреждение", "Сначала выделите объекты на изображении!")
             return
 
+        messages = []
         for bbox in self.bbox_app.bboxes:
             x1, y1, x2, y2 = bbox["coords"]
             description = bbox["description"]
@@ -436,37 +677,61 @@ class JSONDatasetCreator:
             # Format bbox message
             bbox_msg = f"<ref>{description}</ref><box>({int(x1)},{int(y1)}),({int(x2)},{int(y2)})</box>"
 
-            # Add to conversation
-            self.current_conversation.append({"from": "user", "value": f"Отметьте {description}"})
-            self.current_conversation.append({"from": "assistant", "value": bbox_msg})
+            messages.append({"from": "user", "value": f"Отметьте {description}"})
+            messages.append({"from": "assistant", "value": bbox_msg})
 
-        # Update messages
-        self.update_conversation_display()
+        # Add to conversation
+        self.append_messages(messages)
 
         # Clear bboxes
         self.bbox_app.clear_bboxes()
 
+    def _insert_message(self, msg):
+        text = f"{msg['from']}: {msg['value']}\n"
+        self.messages_text.insert(tk.END, text)
+        self.message_lines.append(text.count("\n"))
+
+    @timed_render
     def update_conversation_display(self):
         """Update the conversation display with current messages"""
         self.messages_text.delete(1.0, tk.END)
+        self.message_lines = []
         for msg in self.current_conversation:
-            self.messages_text.insert(tk.END, f"{msg['from']}: {msg['value']}\n")
+            self._insert_message(msg)
+        self.messages_text.see(tk.END)
+
+    @timed_render
+    def append_messages(self, messages):
+        """Add messages to the conversation and only their lines to the display"""
+        for msg in messages:
+            self.current_conversation.append(msg)
+            self._insert_message(msg)
         self.messages_text.see(tk.END)
 
+    @timed_render
+    def remove_message(self, index):
+        """Remove one message and only its lines from the display"""
+        first_line = 1 + sum(self.message_lines[:index])
+        self.messages_text.delete(f"{first_line}.0", f"{first_line + self.message_lines[index]}.0")
+        self.current_conversation.pop(index)
+        self.message_lines.pop(index)
+
     def delete_selected_message(self, event=None):
         """Delete selected message from conversation"""
         if not self.current_conversation:
             return
 
         # Get selected line
-        line = self.messages_text.index("insert").split('.')[0]
-        try:
-            line_num = int(line) - 1
-            if 0 <= line_num < len(self.current_conversation):
-                self.current_conversation.pop(line_num)
-                self.update_conversation_display()
-        except:
-            pass
+        position = f"@{event.x},{event.y}" if event else "insert"
+        line = int(self.messages_text.index(position).split('.')[0])
+
+        # Messages with line breaks span several lines
+        last_line = 0
+        for index, n_lines in enumerate(self.message_lines):
+            last_line += n_lines
+            if line <= last_line:
+                self.remove_message(index)
+                return
 
     def finish_entry(self):
         if not self.current_conversation:
@@ -482,19 +747,25 @@ class JSONDatasetCreator:
             "id": entry_id,
             "conversations": self.current_conversation.copy()
         }
+        if not self.legacy_boxes:
+            # Boxes are drawn in original image pixels
+            entry["box_frame"] = IMAGE_FRAME
+
+        if entry_id != self.editing_id and self.store.has_entry(entry_id):
+            messagebox.showwarning("Предупреждение", f"ID {entry_id} уже используется другой записью!")
+            return
 
-        if self.editing_index is not None:
+        if self.editing_id is not None:
             # Update existing entry
-            self.entries[self.editing_index] = entry
-            self.editing_index = None
+            self.store.save_entry(entry, old_id=self.editing_id)
+            self.entries_list.entry_saved(entry, old_id=self.editing_id)
+            self.editing_id = None
         else:
             # Add new entry
-            self.entries.append(entry)
+            self.store.save_entry(entry)
+            self.entries_list.entry_saved(entry)
             # Increment ID only for new entries
-            self.current_id += 1
-
-        # Update entries list
-        self.update_entries_list()
+            self.current_id = max(self.current_id + 1, self.store.next_id())
 
         # Reset current conversation
         self.reset_conversation()
@@ -502,7 +773,8 @@ class JSONDatasetCreator:
     def reset_conversation(self):
         """Reset conversation to initial state"""
         self.current_conversation = []
-        self.messages_text.delete(1.0, tk.END)
+        self.legacy_boxes = False
+        self.update_conversation_display()
         self.id_entry.delete(0, tk.END)
         self.id_entry.insert(0, f"identity_{self.current_id}")
         self.image_path_entry.delete(0, tk.END)
@@ -510,42 +782,37 @@ class JSONDatasetCreator:
         self.answer_entry.delete(0, tk.END)
         self.bbox_app.clear_bboxes()
 
-    def update_entries_list(self):
-        """Update the entries listbox with current entries"""
-        self.entries_listbox.delete(0, tk.END)
-        for entry in self.entries:
-            self.entries_listbox.insert(tk.END, f"{entry['id']} ({len(entry['conversations'])} сообщений)")
-
     def edit_selected_entry(self, event=None):
         """Load selected entry for editing"""
-        selection = self.entries_listbox.curselection()
-        if not selection:
+        entry_id = self.entries_list.selected_id()
+        if entry_id is None:
             messagebox.showwarning("Предупреждение", "Выберите запись для редактирования!")
             return
 
-        index = selection[0]
-        entry = self.entries[index]
+        entry = self.store.get_entry(entry_id)
+
+        # Boxes of older entries are in pixels of the 800x600 preview, bring them to image pixels
+        converted = self.entry_in_image_frame(entry)
+        self.legacy_boxes = converted is None
+        if converted is not None:
+            entry = converted
 
         # Set editing mode
-        self.editing_index = index
+        self.editing_id = entry['id']
         self.current_conversation = [msg.copy() for msg in entry['conversations']]  # Deep copy
 
         # Update UI
         self.id_entry.delete(0, tk.END)
         self.id_entry.insert(0, entry['id'])
 
-        # Find image path from conversations
+        # Image reference is kept in the store, no need to scan the conversation
         image_path = ""
-        for msg in entry['conversations']:
-            if msg['from'] == 'user' and '<img>' in msg['value']:
-                img_tag = msg['value'].split('<img>')[1].split('</img>')[0]
-                if img_tag.startswith(('http://', 'https://')):
-                    image_path = img_tag
-                else:
-                    # Try to find local file
-                    if os.path.exists(img_tag):
-                        image_path = img_tag
-                break
+        img_tag = self.store.get_image(entry_id)
+        if img_tag.startswith(('http://', 'https://')):
+            image_path = img_tag
+        elif img_tag and os.path.exists(img_tag):
+            # Try to find local file
+            image_path = img_tag
 
         self.image_path_entry.delete(0, tk.END)
         self.image_path_entry.insert(0, image_path)
@@ -559,33 +826,46 @@ class JSONDatasetCreator:
 
         messagebox.showinfo("Редактирование",
                             "Запись загружена для редактирования. Можно удалять сообщения двойным кликом, добавлять новые или изменять существующие.")
+        if self.legacy_boxes:
+            messagebox.showwarning("Предупреждение",
+                                   "Не удалось открыть изображение записи: координаты старой разметки "
+                                   "остались в пикселях превью 800x600, новые рамки добавлять не стоит.")
+
+    def entry_in_image_frame(self, entry):
+        """Entry with its boxes in original image pixels, None if its images cannot be opened"""
+        roots = [os.path.dirname(os.path.abspath(self.current_file))] if self.current_file else []
+        for root in roots + [""]:
+            try:
+                return to_image_frame(entry, root)
+            except OSError:
+                continue
+        return None
 
     def delete_selected_entry(self):
         """Delete selected entry from dataset"""
-        selection = self.entries_listbox.curselection()
-        if not selection:
+        entry_id = self.entries_list.selected_id()
+        if entry_id is None:
             messagebox.showwarning("Предупреждение", "Выберите запись для удаления!")
             return
 
         if messagebox.askyesno("Подтверждение", "Вы действительно хотите удалить выбранную запись?"):
-            index = selection[0]
-            self.entries.pop(index)
-            self.update_entries_list()
+            self.store.delete_entry(entry_id)
+            self.entries_list.entry_deleted(entry_id)
 
             # If we were editing this entry, cancel editing
-            if self.editing_index == index:
-                self.editing_index = None
+            if self.editing_id == entry_id:
+                self.editing_id = None
                 self.reset_conversation()
-            elif self.editing_index is not None and self.editing_index > index:
-                self.editing_index -= 1
 
     def clear_all(self):
         """Clear all data"""
         if messagebox.askyesno("Подтверждение", "Вы действительно хотите очистить все данные?"):
-            self.entries = []
+            # Start a new in-memory store, the file of the previous dataset stays intact
+            self.store.close()
+            self.store = DatasetStore()
+            self.entries_list.set_store(self.store)
             self.current_conversation = []
-            self.entries_listbox.delete(0, tk.END)
-            self.messages_text.delete(1.0, tk.END)
+            self.update_conversation_display()
             self.current_id = 1
             self.id_entry.delete(0, tk.END)
             self.id_entry.insert(0, f"identity_{self.current_id}")
@@ -594,7 +874,8 @@ class JSONDatasetCreator:
             self.answer_entry.delete(0, tk.END)
             self.bbox_app.clear_bboxes()
             self.current_file = None
-            self.editing_index = None
+            self.editing_id = None
+            self.legacy_boxes = False
 
 
 if __name__ == "__main__":
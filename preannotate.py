@@ -0,0 +1,131 @@
+import json
+import multiprocessing as mp
+import os
+import queue
+
+DEFAULT_FIELDS = ("Поставщик",)
+
+
+def field_prompt(field):
+    """Grounding question in the wording used by the dataset"""
+    return f"Отметьте {field}"
+
+
+def _worker(requests, results, variant):
+    """Inference process: answers (image_path, fields) requests with box proposals"""
+    # Heavy imports stay out of the GUI process
+    import torch
+    from PIL import Image
+
+    from constrained import batch_ground
+    from qwen_utils import load_model, load_tokenizer
+
+    torch.manual_seed(1234)
+    tokenizer = load_tokenizer()
+    model = load_model(variant)
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        image_path, fields = request
+        try:
+            with Image.open(image_path) as image:
+                width, height = image.size
+            queries = [
+                tokenizer.from_list_format([{'image': image_path}, {'text': field_prompt(field)}])
+                for field in fields
+            ]
+            proposals = []
+            # Answers are constrained to "<ref>field</ref><box>...</box>", so they always parse
+            for field, (_, boxes, _) in zip(fields, batch_ground(model, tokenizer, queries, list(fields))):
+                for ref, (x1, y1, x2, y2) in boxes:
+                    # Qwen-VL answers with coordinates normalized to 0..1000
+                    proposals.append({
+                        "description": ref or field,
+                        "coords": (x1 * width / 1000, y1 * height / 1000, x2 * width / 1000, y2 * height / 1000),
+                    })
+            results.put((image_path, fields, proposals, None))
+        except Exception as e:
+            results.put((image_path, fields, [], str(e)))
+
+
+class PreannotationClient:
+    """Box proposals from Qwen-VL computed in a separate process.
+
+    Images are queued ahead of the annotator and results are cached per image
+    (path, modification time and field list), optionally in a JSON file, so
+    proposals are usually ready when an image is opened.
+    """
+
+    def __init__(self, fields=DEFAULT_FIELDS, variant="int4", cache_path=None):
+        self.fields = tuple(fields)
+        self.cache_path = cache_path
+        self.cache = {}
+        self.pending = set()
+        self.errors = {}
+
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                self.cache = json.load(f)
+
+        context = mp.get_context("spawn")
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=_worker, args=(self.requests, self.results, variant), daemon=True)
+        self.process.start()
+
+    def _key(self, image_path, fields=None):
+        path = os.path.abspath(image_path)
+        return json.dumps([path, os.path.getmtime(path), list(fields or self.fields)], ensure_ascii=False)
+
+    def get(self, image_path):
+        """Cached proposals of an image or None"""
+        try:
+            return self.cache.get(self._key(image_path))
+        except OSError:
+            return None
+
+    def request(self, image_path):
+        try:
+            key = self._key(image_path)
+        except OSError:
+            return
+        if key in self.cache or key in self.pending:
+            return
+        self.pending.add(key)
+        self.requests.put((os.path.abspath(image_path), self.fields))
+
+    def queue_ahead(self, image_paths):
+        for image_path in image_paths:
+            self.request(image_path)
+
+    def poll(self):
+        """Collect finished results without blocking; returns the paths that got proposals"""
+        finished = []
+        while True:
+            try:
+                image_path, fields, proposals, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                key = self._key(image_path, fields)
+            except OSError:
+                continue
+            self.pending.discard(key)
+            if error:
+                self.errors[image_path] = error
+                continue
+            self.cache[key] = proposals
+            finished.append(image_path)
+
+        if finished and self.cache_path:
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.cache, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        return finished
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join(timeout=5)
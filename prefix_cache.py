@@ -0,0 +1,124 @@
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+from qwen_utils import DEFAULT_SYSTEM, build_context, generation_utils, stop_words_ids
+
+# Qwen keeps past keys/values as [batch, seq, heads, head_dim]
+SEQ_DIM = 1
+
+
+def cache_bytes(past_key_values):
+    return sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
+
+
+def truncate_cache(past_key_values, length):
+    return tuple(tuple(t.narrow(SEQ_DIM, 0, length) for t in layer) for layer in past_key_values)
+
+
+class PrefixKVCache:
+    """Attention KV caches of already processed prompts under a memory budget.
+
+    A new prompt reuses the longest common token prefix with any cached
+    entry, so follow-up turns and other questions about the same image only
+    prefill their own tokens. Least recently used entries are evicted first.
+    """
+
+    def __init__(self, max_bytes=4 << 30):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, tokens):
+        """Return (prefix_length, past_key_values) of the best cached match"""
+        tokens = tuple(tokens)
+        best_key, best_len = None, 0
+        with self._lock:
+            for key in self._entries:
+                length = len(os.path.commonprefix([key, tokens]))
+                if length > best_len:
+                    best_key, best_len = key, length
+            if best_key is None:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            return best_len, self._entries[best_key][0]
+
+    def store(self, tokens, past_key_values):
+        key = tuple(tokens)
+        size = cache_bytes(past_key_values)
+        with self._lock:
+            # An entry that is a prefix of the new one is fully covered by it
+            for old_key in [k for k in self._entries if key[:len(k)] == k]:
+                self.total_bytes -= self._entries.pop(old_key)[1]
+            self._entries[key] = (past_key_values, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.total_bytes}
+
+
+def _reusable_length(tokens, prefix_len, tokenizer):
+    """Shorten the cached prefix so that images are always encoded from scratch.
+
+    Qwen only runs the vision tower when no past is given, so an image that
+    is not entirely inside the cached prefix makes the cache unusable.
+    """
+    prefix = tokens[:prefix_len]
+    if prefix.count(tokenizer.img_start_id) != prefix.count(tokenizer.img_end_id):
+        return 0
+    if tokenizer.img_start_id in tokens[prefix_len:]:
+        return 0
+    return prefix_len
+
+
+def chat(model, tokenizer, query, history=None, cache=None, system=DEFAULT_SYSTEM, generation_config=None):
+    """model.chat that prefills only the part of the prompt missing from the cache"""
+    generation_config = generation_config or model.generation_config
+    history = history if history is not None else []
+    raw_text, tokens = build_context(model, tokenizer, query, history, system, generation_config)
+
+    prefix_len, past = cache.lookup(tokens) if cache else (0, None)
+    # The last prompt token is left to generate so that it produces the first logits
+    prefix_len = _reusable_length(tokens, min(prefix_len, len(tokens) - 1), tokenizer)
+
+    input_ids = torch.tensor([tokens], device=model.device)
+    with torch.no_grad():
+        past = truncate_cache(past, prefix_len) if prefix_len else None
+        if prefix_len < len(tokens) - 1:
+            prefill = model(input_ids[:, prefix_len:-1], past_key_values=past, use_cache=True)
+            past = prefill.past_key_values
+
+        outputs = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past,
+            stop_words_ids=stop_words_ids(model, tokenizer, generation_config),
+            return_dict_in_generate=True,
+            generation_config=generation_config,
+        )
+
+    sequence = outputs.sequences[0]
+    if cache:
+        # The cache covers every token except the last sampled one
+        cache.store(sequence[:-1].tolist(), outputs.past_key_values)
+
+    response = generation_utils(model).decode_tokens(
+        sequence, tokenizer,
+        raw_text_len=len(raw_text),
+        context_length=len(tokens),
+        chat_format=generation_config.chat_format,
+        verbose=False,
+        errors='replace',
+    )
+    history.append((query, response))
+    return response, history
@@ -0,0 +1,261 @@
+import argparse
+import functools
+import inspect
+import json
+import os
+
+import numpy as np
+import torch
+
+from dataset_utils import IMG_RE, image_digest, load_dataset, resolve_message
+from qwen_utils import DEFAULT_SYSTEM, load_tokenizer
+
+IGNORE_TOKEN_ID = -100
+FORMAT_VERSION = 1
+
+
+def tokenize_conversation(tokenizer, conversations, system=DEFAULT_SYSTEM):
+    """Token ids and loss mask of one conversation, laid out like Qwen-VL finetune.py.
+
+    Only assistant answers (plus the chatml im_start/im_end/newline tokens)
+    are trained on.
+    """
+    im_start, im_end = tokenizer.im_start_id, tokenizer.im_end_id
+    nl_tokens = tokenizer('\n').input_ids
+    roles = {"user": tokenizer('user').input_ids, "assistant": tokenizer('assistant').input_ids}
+
+    system_ids = [im_start] + tokenizer('system').input_ids + nl_tokens + tokenizer(system).input_ids + [im_end] + nl_tokens
+    tokens = list(system_ids)
+    loss_mask = [1] + [0] * (len(system_ids) - 3) + [1] * (1 + len(nl_tokens))
+
+    if conversations and conversations[0]['from'] != 'user':
+        conversations = conversations[1:]
+    for msg in conversations:
+        role = roles[msg['from']]
+        content = tokenizer(msg['value']).input_ids
+        tokens += [im_start] + role + nl_tokens + content + [im_end] + nl_tokens
+        if msg['from'] == 'user':
+            loss_mask += [1] + [0] * (len(role) + len(nl_tokens) + len(content)) + [1] * (1 + len(nl_tokens))
+        else:
+            loss_mask += [1] + [0] * (len(role) + len(nl_tokens)) + [1] * (len(content) + 1 + len(nl_tokens))
+    return tokens, loss_mask
+
+
+def _write_shard(out_dir, index, samples):
+    lengths = np.array([len(tokens) for tokens, _ in samples], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    tokens = np.lib.format.open_memmap(
+        os.path.join(out_dir, f"tokens-{index:05d}.npy"), mode='w+', dtype=np.int32, shape=(int(offsets[-1]),))
+    loss_mask = np.lib.format.open_memmap(
+        os.path.join(out_dir, f"loss_mask-{index:05d}.npy"), mode='w+', dtype=np.uint8, shape=(int(offsets[-1]),))
+    for (sample_tokens, sample_mask), start, end in zip(samples, offsets[:-1], offsets[1:]):
+        tokens[start:end] = sample_tokens
+        loss_mask[start:end] = sample_mask
+    tokens.flush()
+    loss_mask.flush()
+    np.save(os.path.join(out_dir, f"offsets-{index:05d}.npy"), offsets)
+
+
+def preprocess(data_path, out_dir, tokenizer=None, system=DEFAULT_SYSTEM, max_len=2048, shard_size=4096):
+    """Tokenize a Dataset.json file into memory-mapped shards.
+
+    Does nothing when out_dir already holds shards of the same file content
+    and settings, so the step can be run before every training run.
+    """
+    meta = {
+        "version": FORMAT_VERSION,
+        "source": os.path.abspath(data_path),
+        "source_sha256": image_digest(data_path),
+        "system": system,
+        "max_len": max_len,
+    }
+    meta_path = os.path.join(out_dir, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            existing = json.load(f)
+        if {key: existing.get(key) for key in meta} == meta:
+            return existing
+
+    tokenizer = tokenizer or load_tokenizer()
+    root = os.path.dirname(os.path.abspath(data_path))
+    os.makedirs(out_dir, exist_ok=True)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    samples, records, shards, truncated = [], [], 0, 0
+    for entry in load_dataset(data_path):
+        conversations = [dict(msg, value=resolve_message(msg['value'], root)) for msg in entry['conversations']]
+        tokens, loss_mask = tokenize_conversation(tokenizer, conversations, system)
+        if len(tokens) > max_len:
+            tokens, loss_mask = tokens[:max_len], loss_mask[:max_len]
+            truncated += 1
+        samples.append((tokens, loss_mask))
+        records.append({
+            "id": entry['id'],
+            "shard": shards,
+            "images": [ref for msg in conversations for ref in IMG_RE.findall(msg['value'])],
+        })
+        if len(samples) == shard_size:
+            _write_shard(out_dir, shards, samples)
+            samples, shards = [], shards + 1
+    if samples:
+        _write_shard(out_dir, shards, samples)
+        shards += 1
+
+    with open(os.path.join(out_dir, "samples.json"), 'w', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False)
+    meta.update(shards=shards, samples=len(records), truncated=truncated)
+    # meta.json is written last and marks the shards as complete
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def pack(lengths, max_len):
+    """First-fit-decreasing packing of sample lengths into rows of max_len tokens"""
+    rows, free = [], []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for row, space in enumerate(free):
+            if lengths[i] <= space:
+                rows[row].append(i)
+                free[row] -= lengths[i]
+                break
+        else:
+            rows.append([i])
+            free.append(max_len - lengths[i])
+    return rows
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    """Fixed-length training rows packed from pre-tokenized shards.
+
+    Shards are memory-mapped, so only the tokens of the requested rows are
+    read. Every row carries segment_ids that PackedAttention turns into a
+    block-diagonal mask; the first token of every segment is not a target, so
+    no conversation is trained to continue another one.
+    """
+
+    def __init__(self, out_dir, max_len=None, pad_token_id=0):
+        with open(os.path.join(out_dir, "meta.json"), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.max_len = max_len or self.meta['max_len']
+        self.pad_token_id = pad_token_id
+
+        self.tokens, self.loss_mask, self.samples = [], [], []
+        for shard in range(self.meta['shards']):
+            self.tokens.append(np.load(os.path.join(out_dir, f"tokens-{shard:05d}.npy"), mmap_mode='r'))
+            self.loss_mask.append(np.load(os.path.join(out_dir, f"loss_mask-{shard:05d}.npy"), mmap_mode='r'))
+            offsets = np.load(os.path.join(out_dir, f"offsets-{shard:05d}.npy"))
+            self.samples.extend((shard, int(start), int(min(end, start + self.max_len)))
+                                for start, end in zip(offsets[:-1], offsets[1:]))
+        self.rows = pack([end - start for _, start, end in self.samples], self.max_len)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        input_ids = np.full(self.max_len, self.pad_token_id, dtype=np.int64)
+        labels = np.full(self.max_len, IGNORE_TOKEN_ID, dtype=np.int64)
+        segment_ids = np.zeros(self.max_len, dtype=np.int64)
+
+        position = 0
+        for segment, sample in enumerate(self.rows[i], 1):
+            shard, start, end = self.samples[sample]
+            length = end - start
+            tokens = self.tokens[shard][start:end]
+            row = slice(position, position + length)
+            input_ids[row] = tokens
+            labels[row] = np.where(self.loss_mask[shard][start:end], tokens, IGNORE_TOKEN_ID)
+            labels[position] = IGNORE_TOKEN_ID
+            segment_ids[row] = segment
+            position += length
+
+        return {
+            "input_ids": torch.from_numpy(input_ids),
+            "labels": torch.from_numpy(labels),
+            "attention_mask": torch.from_numpy((segment_ids > 0).astype(np.int64)),
+            "segment_ids": torch.from_numpy(segment_ids),
+        }
+
+
+def block_diagonal_mask(segment_ids, dtype):
+    """Additive [b, 1, s, s] mask that keeps attention inside each segment"""
+    same = segment_ids[:, None, :, None] == segment_ids[:, None, None, :]
+    mask = torch.zeros(same.shape, dtype=dtype, device=segment_ids.device)
+    return mask.masked_fill(~same, torch.finfo(dtype).min)
+
+
+class PackedAttention:
+    """Restricts Qwen-VL attention to the segments of packed rows.
+
+    QWenModel only accepts a [b, s] padding mask, so the model forward takes
+    segment_ids instead and the block-diagonal mask is handed to every
+    attention module with a forward pre-hook (the causal mask is applied by
+    the attention itself). Position ids need no reset: rotary embeddings only
+    depend on relative positions, which are the same inside a segment.
+
+    The replacement forward keeps the signature of the original plus
+    segment_ids, since Trainer picks the dataset columns it keeps from it.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.mask = None
+        self.handles = [
+            module.register_forward_pre_hook(self._hook, with_kwargs=True)
+            for name, module in model.named_modules() if name.split(".")[-3:-2] == ["h"] and name.endswith(".attn")
+        ]
+        self._forward = model.forward
+
+        def forward(*args, segment_ids=None, **kwargs):
+            return self.forward(*args, segment_ids=segment_ids, **kwargs)
+
+        functools.update_wrapper(forward, self._forward)
+        signature = inspect.signature(self._forward)
+        parameters = [p for p in signature.parameters.values() if p.kind != inspect.Parameter.VAR_KEYWORD]
+        parameters.append(inspect.Parameter("segment_ids", inspect.Parameter.KEYWORD_ONLY, default=None))
+        parameters.extend(p for p in signature.parameters.values() if p.kind == inspect.Parameter.VAR_KEYWORD)
+        forward.__signature__ = signature.replace(parameters=parameters)
+        model.forward = forward
+
+    def _hook(self, module, args, kwargs):
+        if self.mask is not None and 'attention_mask' in kwargs:
+            kwargs['attention_mask'] = self.mask
+        return args, kwargs
+
+    def forward(self, *args, segment_ids=None, **kwargs):
+        # The mask outlives the forward call: gradient checkpointing runs the
+        # attention again during backward
+        if segment_ids is None:
+            self.mask = None
+            return self._forward(*args, **kwargs)
+        dtype = next(self.model.parameters()).dtype
+        if not dtype.is_floating_point:
+            dtype = torch.float16
+        self.mask = block_diagonal_mask(segment_ids, dtype)
+        kwargs.pop('attention_mask', None)
+        return self._forward(*args, **kwargs)
+
+    def remove(self):
+        self.mask = None
+        for handle in self.handles:
+            handle.remove()
+        self.model.forward = self._forward
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenize a Dataset.json file into memory-mapped training shards")
+    parser.add_argument("data_path", help="Dataset.json-format input")
+    parser.add_argument("out_dir", help="Directory of the shards")
+    parser.add_argument("--max-len", type=int, default=2048, help="Packed row length (finetune.py model_max_length)")
+    parser.add_argument("--shard-size", type=int, default=4096, help="Conversations per shard")
+    args = parser.parse_args()
+
+    meta = preprocess(args.data_path, args.out_dir, max_len=args.max_len, shard_size=args.shard_size)
+    dataset = PackedDataset(args.out_dir)
+    print(f"{meta['samples']} conversations in {meta['shards']} shards ({meta['truncated']} truncated), "
+          f"{len(dataset)} packed rows of {dataset.max_len} tokens")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import torch
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class Tracer:
+    """Timings of the inference stages and token counters.
+
+    Spans are kept as Chrome trace events (chrome://tracing, Perfetto) and
+    aggregated per stage for a Prometheus text snapshot. A disabled tracer
+    hands out a shared no-op span and instrument() installs no hooks, so
+    instrumentation costs a single attribute check.
+    """
+
+    def __init__(self, enabled=True, max_events=100000, cuda_sync=False):
+        self.enabled = enabled
+        # Waiting for CUDA kernels makes GPU stage times exact but slows them down
+        self.cuda_sync = cuda_sync
+        self.events = deque(maxlen=max_events)
+        self.stages = {}
+        self.counters = {}
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def record(self, name, start, end, args=None):
+        if self.cuda_sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+            end = time.perf_counter()
+        event = {
+            "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+            "ts": (start - self._origin) * 1e6, "dur": (end - start) * 1e6,
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+            count, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (count + 1, total + end - start)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def chrome_trace(self):
+        with self._lock:
+            return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def prometheus(self, prefix="qwen_vl"):
+        """Prometheus text exposition of the stage timings and counters"""
+        with self._lock:
+            stages = dict(self.stages)
+            counters = dict(self.counters)
+        lines = [f"# TYPE {prefix}_stage_seconds summary"]
+        for name, (count, total) in sorted(stages.items()):
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {count}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {total:.6f}')
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _wrap(tracer, name, fn):
+    def traced(*args, **kwargs):
+        with tracer.span(name):
+            return fn(*args, **kwargs)
+    return traced
+
+
+def instrument(model, tokenizer, tracer):
+    """Time image loading/transform, the visual encoder, prefill, decode steps and box drawing.
+
+    Nothing is installed when the tracer is disabled.
+    """
+    if not tracer.enabled:
+        return []
+
+    visual = model.transformer.visual
+    # encode() opens the images, applies image_transform and runs the encoder;
+    # image loading is the part of visual_encode not covered by the other two
+    visual.encode = _wrap(tracer, "visual_encode", visual.encode)
+    visual.image_transform = _wrap(tracer, "image_transform", visual.image_transform)
+    tokenizer.draw_bbox_on_latest_picture = _wrap(
+        tracer, "draw_bbox_on_latest_picture", tokenizer.draw_bbox_on_latest_picture)
+
+    local = threading.local()
+
+    def visual_start(module, args):
+        local.visual_start = time.perf_counter()
+
+    def visual_end(module, args, output):
+        tracer.record("visual_forward", local.visual_start, time.perf_counter())
+
+    def transformer_start(module, args, kwargs):
+        input_ids = kwargs.get('input_ids', args[0] if args else None)
+        past = kwargs.get('past_key_values')
+        is_prefill = past is None or past[0] is None or (input_ids is not None and input_ids.shape[-1] > 1)
+        local.transformer = (time.perf_counter(), is_prefill, input_ids)
+
+    def transformer_end(module, args, kwargs, output):
+        start, is_prefill, input_ids = local.transformer
+        tokens = input_ids.numel() if input_ids is not None else 0
+        if is_prefill:
+            tracer.record("prefill", start, time.perf_counter(), {"tokens": tokens})
+            tracer.count("prompt_tokens", tokens)
+        else:
+            tracer.record("decode_step", start, time.perf_counter(), {"tokens": tokens})
+            tracer.count("generated_tokens", tokens)
+
+    return [
+        visual.register_forward_pre_hook(visual_start),
+        visual.register_forward_hook(visual_end),
+        model.transformer.register_forward_pre_hook(transformer_start, with_kwargs=True),
+        model.transformer.register_forward_hook(transformer_end, with_kwargs=True),
+    ]
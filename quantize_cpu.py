@@ -0,0 +1,95 @@
+import argparse
+import gc
+import json
+import os
+import tempfile
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM
+from transformers.dynamic_module_utils import get_class_from_dynamic_module
+from transformers.generation import GenerationConfig
+
+from qwen_utils import BASE_MODEL
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "qwen-vl-int8")
+
+
+def checkpoint_revision():
+    """Commit of the BASE_MODEL checkpoint in the Hugging Face cache, "local" for a plain directory"""
+    config = AutoConfig.from_pretrained(BASE_MODEL, trust_remote_code=True)
+    return (getattr(config, "_commit_hash", None) or "local")[:12]
+
+
+def cache_path(cache_dir=DEFAULT_CACHE_DIR):
+    """Cache file of the int8 model; a new checkpoint revision or torch version gets a new file"""
+    name = BASE_MODEL.replace("/", "--")
+    return os.path.join(cache_dir, f"{name}@{checkpoint_revision()}-int8-torch{torch.__version__}.pt")
+
+
+def quantize(model):
+    """Dynamic int8 quantization of every nn.Linear, language model and visual encoder alike.
+
+    Weights are stored as int8, activations are quantized on the fly, so no
+    calibration data is needed.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_int8_model(cache_dir=DEFAULT_CACHE_DIR):
+    """CPU int8 model, quantized from the fp32 checkpoint on first use and cached on disk"""
+    path = cache_path(cache_dir)
+    # The pickled model refers to the remote-code module, make sure it is importable
+    get_class_from_dynamic_module("modeling_qwen.QWenLMHeadModel", BASE_MODEL)
+
+    if os.path.exists(path):
+        model = torch.load(path, weights_only=False)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(BASE_MODEL, device_map="cpu", trust_remote_code=True).eval()
+        model = quantize(model)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + ".tmp"
+        torch.save(model, tmp_path)
+        os.replace(tmp_path, path)
+
+    model.generation_config = GenerationConfig.from_pretrained(BASE_MODEL, trust_remote_code=True)
+    return model.eval()
+
+
+def compare(data_path, variants=("cpu", "int8-cpu"), batch_size=4, cache_dir=DEFAULT_CACHE_DIR):
+    """Speed and accuracy of several load variants on the same evaluation set"""
+    from batch_inference import run
+    from evaluation import evaluate, load_predictions
+    from qwen_utils import load_model, load_tokenizer
+
+    tokenizer = load_tokenizer()
+    report = {}
+    for variant in variants:
+        torch.manual_seed(1234)
+        model = load_int8_model(cache_dir) if variant == "int8-cpu" else load_model(variant)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, "predictions.jsonl")
+            stats = run(model, tokenizer, data_path, output_path, batch_size)
+            report[variant] = {"speed": stats, "accuracy": evaluate(load_predictions(output_path))}
+        # Only one copy of the weights at a time
+        del model
+        gc.collect()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the int8 CPU model and compare it with fp32")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--check", metavar="DATA_PATH",
+                        help="Dataset.json-format evaluation set to compare int8 with fp32 on")
+    parser.add_argument("--batch-size", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.check:
+        print(json.dumps(compare(args.check, batch_size=args.batch_size, cache_dir=args.cache_dir), ensure_ascii=False, indent=2))
+    else:
+        load_int8_model(args.cache_dir)
+        print(cache_path(args.cache_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import importlib
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers.generation import GenerationConfig
+
+BASE_MODEL = "Qwen/Qwen-VL-Chat"
+INT4_MODEL = "Qwen/Qwen-VL-Chat-Int4"
+DEFAULT_SYSTEM = "You are a helpful assistant."
+
+# Loading options of Qwen.py: (checkpoint, from_pretrained kwargs)
+LOAD_VARIANTS = {
+    "int4": (INT4_MODEL, {"device_map": "auto"}),
+    "bf16": (BASE_MODEL, {"device_map": "auto", "bf16": True}),
+    "fp16": (BASE_MODEL, {"device_map": "auto", "fp16": True}),
+    "cpu": (BASE_MODEL, {"device_map": "cpu"}),
+    # Dynamic int8 quantization of the fp32 model, built by quantize_cpu.py
+    "int8-cpu": (BASE_MODEL, {"device_map": "cpu"}),
+}
+
+
+def load_tokenizer():
+    return AutoTokenizer.from_pretrained(BASE_MODEL, trust_remote_code=True)
+
+
+def load_model(variant="int4"):
+    """Load the chat model the same way Qwen.py does"""
+    if variant == "int8-cpu":
+        from quantize_cpu import load_int8_model
+        return load_int8_model()
+
+    name, kwargs = LOAD_VARIANTS[variant]
+    model = AutoModelForCausalLM.from_pretrained(name, trust_remote_code=True, **kwargs).eval()
+
+    # Specify hyperparameters for generation
+    model.generation_config = GenerationConfig.from_pretrained(BASE_MODEL, trust_remote_code=True)
+    return model
+
+
+def generation_utils(model):
+    """Return the remote-code module that provides make_context/decode_tokens"""
+    # PEFT wrappers forward attributes to the model but live in their own module
+    if hasattr(model, "get_base_model"):
+        model = model.get_base_model()
+    return importlib.import_module(type(model).__module__)
+
+
+def build_context(model, tokenizer, query, history=None, system=DEFAULT_SYSTEM, generation_config=None):
+    """Build the chatml prompt exactly like model.chat does"""
+    generation_config = generation_config or model.generation_config
+    return generation_utils(model).make_context(
+        tokenizer, query,
+        history=history or [],
+        system=system,
+        max_window_size=generation_config.max_window_size,
+        chat_format=generation_config.chat_format,
+    )
+
+
+def stop_words_ids(model, tokenizer, generation_config=None):
+    generation_config = generation_config or model.generation_config
+    return generation_utils(model).get_stop_words_ids(generation_config.chat_format, tokenizer)
+
+
+def count_generated(tokens, tokenizer):
+    """Number of generated tokens before the first end-of-turn token"""
+    stop_ids = {tokenizer.im_start_id, tokenizer.im_end_id, tokenizer.eod_id}
+    for i, token in enumerate(tokens):
+        if token in stop_ids:
+            return i
+    return len(tokens)
+
+
+def batch_chat(model, tokenizer, queries, histories=None, system=DEFAULT_SYSTEM, generation_config=None,
+               logits_processor=None):
+    """Answer several independent queries with a single left-padded generate call.
+
+    Returns a list of (response, generated_tokens) in the order of queries.
+    """
+    generation_config = generation_config or model.generation_config
+    histories = histories or [None] * len(queries)
+    utils = generation_utils(model)
+
+    contexts = [
+        build_context(model, tokenizer, query, history, system, generation_config)
+        for query, history in zip(queries, histories)
+    ]
+    max_len = max(len(tokens) for _, tokens in contexts)
+
+    # Left padding keeps the last prompt token of every row aligned
+    input_ids = torch.full((len(contexts), max_len), tokenizer.eod_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(contexts), max_len), dtype=torch.long)
+    for row, (_, tokens) in enumerate(contexts):
+        input_ids[row, max_len - len(tokens):] = torch.tensor(tokens, dtype=torch.long)
+        attention_mask[row, max_len - len(tokens):] = 1
+
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids.to(model.device),
+            attention_mask=attention_mask.to(model.device),
+            stop_words_ids=stop_words_ids(model, tokenizer, generation_config),
+            return_dict_in_generate=False,
+            generation_config=generation_config,
+            logits_processor=logits_processor,
+        )
+
+    results = []
+    for row, (raw_text, tokens) in enumerate(contexts):
+        output = outputs[row][max_len - len(tokens):]
+        response = utils.decode_tokens(
+            output, tokenizer,
+            raw_text_len=len(raw_text),
+            context_length=len(tokens),
+            chat_format=generation_config.chat_format,
+            verbose=False,
+            errors='replace',
+        )
+        results.append((response, count_generated(output[len(tokens):].tolist(), tokenizer)))
+    return results
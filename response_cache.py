@@ -0,0 +1,163 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import torch
+
+from dataset_utils import IMG_RE, image_digest
+from feature_cache import model_revision
+from qwen_utils import DEFAULT_SYSTEM, batch_chat
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    generated INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used);
+"""
+
+
+def _config_value(value):
+    # Sets (target_modules) have no stable order in JSON
+    return sorted(value) if isinstance(value, (set, frozenset)) else str(value)
+
+
+def adapter_revision(model):
+    """Model revision plus a digest of the active LoRA adapter's config and weights, if any"""
+    revision = model_revision(model)
+    if hasattr(model, "peft_config"):
+        from peft import get_peft_model_state_dict
+
+        name = model.active_adapter
+        config = model.peft_config[name].to_dict()
+        digest = hashlib.sha256(json.dumps(config, sort_keys=True, default=_config_value).encode('utf-8'))
+        state = get_peft_model_state_dict(model, adapter_name=name)
+        for key in sorted(state):
+            digest.update(key.encode('utf-8'))
+            digest.update(state[key].detach().cpu().contiguous().view(torch.uint8).numpy().tobytes())
+        revision += f"+lora:{digest.hexdigest()}"
+    return revision
+
+
+def _with_digests(text, digests):
+    """A prompt with image paths replaced by content hashes, so moved files still hit the cache"""
+    def replace(match):
+        path = match.group(1)
+        if path not in digests:
+            try:
+                digests[path] = image_digest(path)
+            except OSError:
+                digests[path] = path
+        return f"<img>{digests[path]}</img>"
+    return IMG_RE.sub(replace, text)
+
+
+class ResponseCache:
+    """Persistent chat answers keyed by everything that determines them.
+
+    The key covers the image contents, the query, the history, the system
+    prompt, the generation config (sampling parameters included) and the
+    model/adapter revision. A stored answer is only canonical for greedy
+    decoding, so cached_batch_chat does not use the cache when do_sample is
+    set. Entries live in SQLite and the least recently used ones are
+    evicted when the total size exceeds max_bytes. With bypass set, cached
+    answers are ignored and overwritten.
+    """
+
+    def __init__(self, path, max_bytes=256 << 20, revision="", bypass=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.revision = revision
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        # Answers generated with sampling, which are never stored
+        self.sampled = 0
+        self._digests = {}
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def key(self, query, history=None, system="", generation_config=None):
+        config = generation_config.to_dict() if generation_config is not None else None
+        payload = {
+            "query": _with_digests(query, self._digests),
+            "history": [[_with_digests(q, self._digests), a] for q, a in history or []],
+            "system": system,
+            "generation_config": config,
+            "revision": self.revision,
+        }
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+                              .encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """(response, generated_tokens) or None"""
+        with self._lock:
+            row = None
+            if not self.bypass:
+                row = self.conn.execute("SELECT response, generated FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.conn:
+                self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row
+
+    def put(self, key, response, generated):
+        size = len(key) + len(response.encode('utf-8'))
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                              (key, response, generated, size, time.time()))
+            self._evict()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_used")
+        stale = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def stats(self):
+        entries, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "sampled": self.sampled, "entries": entries,
+                "bytes": total}
+
+
+def cached_batch_chat(cache, model, tokenizer, queries, histories=None, system=DEFAULT_SYSTEM,
+                      generation_config=None):
+    """batch_chat that answers cached queries from the cache and only generates the rest.
+
+    With do_sample set every answer is a random draw, so nothing is looked
+    up or stored.
+    """
+    generation_config = generation_config or model.generation_config
+    if generation_config.do_sample:
+        cache.sampled += len(queries)
+        return batch_chat(model, tokenizer, queries, histories, system, generation_config)
+    histories = histories or [None] * len(queries)
+
+    keys = [cache.key(query, history, system, generation_config) for query, history in zip(queries, histories)]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        answers = batch_chat(model, tokenizer, [queries[i] for i in missing], [histories[i] for i in missing],
+                             system, generation_config)
+        for i, (response, generated) in zip(missing, answers):
+            cache.put(keys[i], response, generated)
+            results[i] = (response, generated)
+    return [tuple(result) for result in results]
@@ -0,0 +1,241 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+from feature_cache import VisualFeatureCache, model_revision
+from lora_tools import AdapterPool, load_merged, parse_adapters
+from profiling import Tracer, instrument
+from qwen_utils import LOAD_VARIANTS, batch_chat, load_model, load_tokenizer
+
+
+class BatchScheduler:
+    """Collects concurrent chat requests and answers them in micro-batches.
+
+    With an AdapterPool, every batch only holds requests for the same
+    adapter; requests for other adapters wait for one of the next batches.
+    Queued and deferred requests both count toward max_queue.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=8, max_wait_ms=20, max_queue=64, adapters=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.adapters = adapters
+        self._deferred = deque()
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.requests = queue.Queue()
+        # Requests queued or deferred, not yet taken into a batch
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+        self.worker = threading.Thread(target=self._loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, query, history, adapter=None):
+        """Queue a request; raises queue.Full when the server is saturated"""
+        future = Future()
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                raise queue.Full
+            self._waiting += 1
+        self.requests.put_nowait((query, history, future, adapter))
+        return future
+
+    def depth(self):
+        return self._waiting
+
+    def _next_batch(self):
+        batch = [self._deferred.popleft() if self._deferred else self.requests.get()]
+        adapter = batch[0][3]
+        for request in list(self._deferred):
+            if len(batch) == self.max_batch_size:
+                break
+            if request[3] == adapter:
+                self._deferred.remove(request)
+                batch.append(request)
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request[3] == adapter:
+                batch.append(request)
+            else:
+                self._deferred.append(request)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            with self._lock:
+                self._waiting -= len(batch)
+            try:
+                with self.adapters.use(batch[0][3]) if self.adapters else nullcontext(self.model) as model:
+                    results = batch_chat(
+                        model, self.tokenizer,
+                        [query for query, _, _, _ in batch],
+                        [history for _, history, _, _ in batch],
+                    )
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for (query, history, future, _), (response, _) in zip(batch, results):
+                future.set_result((response, history + [(query, response)]))
+
+
+def parse_request(request):
+    """Question and history of a /chat request body; raises TypeError when a field has the wrong type"""
+    if not isinstance(request, dict):
+        raise TypeError("expected a JSON object")
+    question = request['question']
+    if not isinstance(question, str):
+        raise TypeError("question must be a string")
+    for field in ('image', 'adapter'):
+        if request.get(field) is not None and not isinstance(request[field], str):
+            raise TypeError(f"{field} must be a string")
+    history = request.get('history') or []
+    if not isinstance(history, list) or not all(
+            isinstance(turn, list) and len(turn) == 2 and all(isinstance(text, str) for text in turn)
+            for turn in history):
+        raise TypeError("history must be a list of [question, answer] pairs")
+    return question, [tuple(turn) for turn in history]
+
+
+class ChatHandler(BaseHTTPRequestHandler):
+    scheduler = None
+    feature_cache = None
+    tracer = Tracer(enabled=False)
+    request_timeout = 300
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, status, text):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics" and self.tracer.enabled:
+            self._send_text(200, self.tracer.prometheus())
+            return
+        if self.path == "/trace" and self.tracer.enabled:
+            self._send_json(200, self.tracer.chrome_trace())
+            return
+        if self.path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        status = {"status": "ok", "queue_depth": self.scheduler.depth()}
+        if self.feature_cache:
+            status["feature_cache"] = self.feature_cache.stats()
+        self._send_json(200, status)
+
+    def do_POST(self):
+        if self.path != "/chat":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            question, history = parse_request(request)
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"bad request: {e}"})
+            return
+
+        # Same query layout as Qwen.py: optional image followed by the question
+        items = []
+        if request.get('image'):
+            items.append({'image': request['image']})
+        items.append({'text': question})
+        query = self.scheduler.tokenizer.from_list_format(items)
+
+        adapter = request.get('adapter')
+        adapters = self.scheduler.adapters
+        if adapter is not None and (adapters is None or adapter not in adapters.names):
+            self._send_json(400, {"error": f"unknown adapter: {adapter}"})
+            return
+
+        self.tracer.count("requests")
+        try:
+            future = self.scheduler.submit(query, history, adapter)
+        except queue.Full:
+            self._send_json(503, {"error": "server busy"}, {"Retry-After": "1"})
+            return
+
+        try:
+            response, history = future.result(timeout=self.request_timeout)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {"response": response, "history": history})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Qwen-VL chat server with dynamic batching")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--variant", choices=sorted(LOAD_VARIANTS), default="int4")
+    parser.add_argument("--checkpoint", help="Checkpoint written by lora_tools.py, used instead of --variant")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20, help="Batching window")
+    parser.add_argument("--max-queue", type=int, default=64, help="Requests above this are rejected with 503")
+    parser.add_argument("--feature-cache", help="Directory of the visual feature cache")
+    parser.add_argument("--feature-cache-mb", type=int, default=2048)
+    parser.add_argument("--adapter", action="append", default=[], metavar="NAME=PATH",
+                        help="LoRA adapter selectable per request with {\"adapter\": NAME}; repeatable")
+    parser.add_argument("--trace", action="store_true", help="Time the inference stages, served on /metrics and /trace")
+    args = parser.parse_args()
+
+    torch.manual_seed(1234)
+    tokenizer = load_tokenizer()
+    model = load_merged(args.checkpoint) if args.checkpoint else load_model(args.variant)
+
+    if args.feature_cache:
+        ChatHandler.feature_cache = VisualFeatureCache(
+            args.feature_cache, args.feature_cache_mb << 20, model_revision(model))
+        ChatHandler.feature_cache.install(model)
+
+    if args.trace:
+        ChatHandler.tracer = Tracer()
+        instrument(model, tokenizer, ChatHandler.tracer)
+
+    adapters = AdapterPool(model, parse_adapters(args.adapter)) if args.adapter else None
+    ChatHandler.scheduler = BatchScheduler(
+        model, tokenizer, args.max_batch_size, args.max_wait_ms, args.max_queue, adapters)
+    server = ThreadingHTTPServer((args.host, args.port), ChatHandler)
+    print(f"Serving on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
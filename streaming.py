@@ -0,0 +1,148 @@
+import queue
+import threading
+import time
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+from qwen_utils import DEFAULT_SYSTEM, build_context, count_generated, generation_utils, stop_words_ids
+
+
+class StreamTimings:
+    """Time to first token and inter-token latencies of one streamed answer"""
+
+    def __init__(self):
+        self.start = None
+        self.token_times = []
+
+    @property
+    def time_to_first_token(self):
+        if not self.token_times:
+            return None
+        return self.token_times[0] - self.start
+
+    @property
+    def inter_token_latencies(self):
+        return [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+
+    @property
+    def decode_tokens_per_s(self):
+        if len(self.token_times) < 2:
+            return None
+        return (len(self.token_times) - 1) / (self.token_times[-1] - self.token_times[0])
+
+    def as_dict(self):
+        return {
+            "time_to_first_token": self.time_to_first_token,
+            "inter_token_latencies": self.inter_token_latencies,
+            "decode_tokens_per_s": self.decode_tokens_per_s,
+            "tokens": len(self.token_times),
+        }
+
+
+class _TokenStreamer(BaseStreamer):
+    """Passes generated token ids from the generate thread to the consumer"""
+
+    def __init__(self, timings):
+        self.timings = timings
+        self.tokens = queue.Queue()
+        self.prompt_skipped = False
+
+    def put(self, value):
+        # generate() hands over the prompt first
+        if not self.prompt_skipped:
+            self.prompt_skipped = True
+            return
+        self.timings.token_times.append(time.perf_counter())
+        self.tokens.put(value.flatten().tolist())
+
+    def end(self):
+        self.tokens.put(None)
+
+
+class ChatStream:
+    """Streaming variant of model.chat.
+
+    Iterating yields text increments as tokens are decoded; surrounding
+    whitespace is held back like model.chat strips it. Once the iteration
+    is over, response and history hold the same values that model.chat
+    would have returned:
+
+        stream = ChatStream(model, tokenizer, 'Кто поставщик?', history)
+        for text in stream:
+            print(text, end="", flush=True)
+        image = tokenizer.draw_bbox_on_latest_picture(stream.response, stream.history)
+    """
+
+    def __init__(self, model, tokenizer, query, history=None, system=DEFAULT_SYSTEM, generation_config=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.query = query
+        self.history = history if history is not None else []
+        self.system = system
+        self.generation_config = generation_config or model.generation_config
+        self.response = None
+        self.timings = StreamTimings()
+
+    def _generate(self, input_ids, streamer, errors):
+        try:
+            with torch.no_grad():
+                self.model.generate(
+                    input_ids,
+                    stop_words_ids=stop_words_ids(self.model, self.tokenizer, self.generation_config),
+                    generation_config=self.generation_config,
+                    streamer=streamer,
+                )
+        except Exception as e:
+            errors.append(e)
+            streamer.end()
+
+    def __iter__(self):
+        raw_text, context_tokens = build_context(
+            self.model, self.tokenizer, self.query, self.history, self.system, self.generation_config)
+        input_ids = torch.tensor([context_tokens]).to(self.model.device)
+
+        streamer = _TokenStreamer(self.timings)
+        errors = []
+        self.timings.start = time.perf_counter()
+        thread = threading.Thread(target=self._generate, args=(input_ids, streamer, errors), daemon=True)
+        thread.start()
+
+        tokens = []
+        text = ""
+        finished = False
+        while True:
+            new_tokens = streamer.tokens.get()
+            if new_tokens is None:
+                break
+            if finished:
+                continue
+            tokens.extend(new_tokens)
+
+            # Stop words end the answer; generate may still emit padding after them
+            n_answer = count_generated(tokens, self.tokenizer)
+            finished = n_answer < len(tokens)
+            decoded = self.tokenizer.decode(tokens[:n_answer], errors='replace').lstrip()
+            if not finished:
+                # Wait for the rest of a multi-byte character and for text after trailing whitespace
+                decoded = decoded.rstrip("�").rstrip()
+            if len(decoded) > len(text):
+                yield decoded[len(text):]
+                text = decoded
+
+        thread.join()
+        if errors:
+            raise errors[0]
+
+        # Decode the final answer exactly like model.chat
+        self.response = generation_utils(self.model).decode_tokens(
+            context_tokens + tokens, self.tokenizer,
+            raw_text_len=len(raw_text),
+            context_length=len(context_tokens),
+            chat_format=self.generation_config.chat_format,
+            verbose=False,
+            errors='replace',
+        )
+        if self.response.startswith(text) and len(self.response) > len(text):
+            yield self.response[len(text):]
+        self.history.append((self.query, self.response))
@@ -0,0 +1,254 @@
+import math
+from collections import OrderedDict
+
+import tkinter as tk
+from PIL import Image, ImageTk
+
+TILE_SIZE = 256
+
+
+def decode_tiles(path, level_size, boxes):
+    """Decode tiles of a pyramid level, given as boxes in level pixels.
+
+    PIL decodes whole images, so the image is decoded once for all the
+    boxes (JPEG straight at a reduced scale close to the level) and dropped
+    again; only the tiles are returned.
+    """
+    with Image.open(path) as image:
+        # JPEG can be decoded directly at 1/2, 1/4 or 1/8 scale
+        if image.format == "JPEG":
+            image.draft("RGB", level_size)
+        sx, sy = image.width / level_size[0], image.height / level_size[1]
+        return [image.resize((x1 - x0, y1 - y0), Image.Resampling.BOX, box=(x0 * sx, y0 * sy, x1 * sx, y1 * sy))
+                for x0, y0, x1, y1 in boxes]
+
+
+class TilePyramid:
+    """Tiles of an image at several scales, decoded only when needed.
+
+    Scales are powers of two plus the scale of the small preview decoded by
+    ImageLoader. Tiles up to the preview scale are cut from the preview;
+    tiles of finer levels are decoded on the executor, all missing tiles in
+    view in one job, once the user zooms in past the preview. Only the
+    max_tiles most recently used tiles are kept, so the memory held does
+    not depend on the scan resolution. A decode job still needs the whole
+    image in memory while it runs, at the JPEG draft scale for JPEG files
+    and at full resolution for other formats.
+    """
+
+    def __init__(self, path, preview, executor, max_tiles=256):
+        self.path = path
+        self.preview = preview
+        self.executor = executor
+        self.max_tiles = max_tiles
+        with Image.open(path) as image:
+            self.width, self.height = image.size
+        self.preview_scale = min(1.0, preview.width / self.width)
+
+        # scale: (tile positions, future) of the decode job running for that level
+        self._pending = {}
+        self._tiles = OrderedDict()
+
+    def level_size(self, scale):
+        return max(1, round(self.width * scale)), max(1, round(self.height * scale))
+
+    def scale_for(self, zoom):
+        """Coarsest available scale that still has at least `zoom` pixels per image pixel"""
+        scales = [self.preview_scale]
+        scale = 1.0
+        while max(self.level_size(scale)) >= TILE_SIZE:
+            scales.append(scale)
+            scale /= 2
+        sufficient = [scale for scale in scales if scale >= zoom]
+        return min(sufficient) if sufficient else 1.0
+
+    def tile_box(self, scale, tx, ty):
+        width, height = self.level_size(scale)
+        return tx * TILE_SIZE, ty * TILE_SIZE, min((tx + 1) * TILE_SIZE, width), min((ty + 1) * TILE_SIZE, height)
+
+    def _preview_tile(self, scale, tx, ty):
+        x0, y0, x1, y1 = self.tile_box(scale, tx, ty)
+        factor = self.preview_scale / scale
+        box = (x0 * factor, y0 * factor, min(x1 * factor, self.preview.width), min(y1 * factor, self.preview.height))
+        return self.preview.resize((x1 - x0, y1 - y0), Image.Resampling.BOX, box=box)
+
+    def _store(self, key, tile):
+        self._tiles[key] = tile
+        while len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+
+    def _collect(self, scale):
+        """Move the tiles of a finished decode job of a level into the cache"""
+        positions, future = self._pending.get(scale, (None, None))
+        if future is None or not future.done():
+            return
+        del self._pending[scale]
+        for position, tile in zip(positions, future.result()):
+            self._store((scale,) + position, tile)
+
+    def tiles(self, scale, positions):
+        """Tiles at (tx, ty) positions of a level, None while some of them are being decoded"""
+        self._collect(scale)
+        missing = [position for position in positions if (scale,) + position not in self._tiles]
+        if missing and scale <= self.preview_scale:
+            for position in missing:
+                self._store((scale,) + position, self._preview_tile(scale, *position))
+        elif missing:
+            if scale not in self._pending:
+                boxes = [self.tile_box(scale, *position) for position in missing]
+                self._pending[scale] = (missing, self.executor.submit(
+                    decode_tiles, self.path, self.level_size(scale), boxes))
+            return None
+
+        result = []
+        for position in positions:
+            self._tiles.move_to_end((scale,) + position)
+            result.append(self._tiles[(scale,) + position])
+        return result
+
+
+class TiledImageView:
+    """Zoom and pan of a TilePyramid on a canvas.
+
+    Only the tiles intersecting the canvas are turned into PhotoImages, so
+    memory and redraw cost do not depend on the scan resolution. Positions
+    outside the view are given in original image pixels.
+    """
+
+    def __init__(self, canvas, on_change=None, min_zoom=0.05, max_zoom=8.0):
+        self.canvas = canvas
+        self.on_change = on_change
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.pyramid = None
+        self.zoom = 1.0
+        self.offset_x = 0.0
+        self.offset_y = 0.0
+        self._items = {}
+        self._items_zoom = None
+        self._pan_start = None
+        self._pending_render = None
+
+        canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        canvas.bind("<ButtonPress-3>", self.on_pan_start)
+        canvas.bind("<B3-Motion>", self.on_pan)
+        canvas.bind("<Configure>", lambda e: self.render())
+
+    def image_to_canvas(self, x, y):
+        return (x - self.offset_x) * self.zoom, (y - self.offset_y) * self.zoom
+
+    def canvas_to_image(self, x, y):
+        return x / self.zoom + self.offset_x, y / self.zoom + self.offset_y
+
+    def clear(self):
+        self.canvas.delete("tile")
+        self._items = {}
+
+    def set_pyramid(self, pyramid):
+        self.clear()
+        self.pyramid = pyramid
+        self.fit()
+
+    def fit(self):
+        """Show the whole image"""
+        if not self.pyramid:
+            return
+        width = max(self.canvas.winfo_width(), int(self.canvas.cget("width")))
+        height = max(self.canvas.winfo_height(), int(self.canvas.cget("height")))
+        self.zoom = min(width / self.pyramid.width, height / self.pyramid.height, 1.0)
+        self.offset_x = self.offset_y = 0.0
+        self.changed()
+
+    def zoom_at(self, x, y, factor):
+        """Zoom keeping the image point under canvas position (x, y) in place"""
+        image_x, image_y = self.canvas_to_image(x, y)
+        self.zoom = min(self.max_zoom, max(self.min_zoom, self.zoom * factor))
+        self.offset_x = image_x - x / self.zoom
+        self.offset_y = image_y - y / self.zoom
+        self.changed()
+
+    def changed(self):
+        self.render()
+        if self.on_change:
+            self.on_change()
+
+    def on_mouse_wheel(self, event):
+        self.zoom_at(event.x, event.y, 1.25 if event.delta > 0 else 0.8)
+        # Keep the main window from scrolling too
+        return "break"
+
+    def on_pan_start(self, event):
+        self._pan_start = (event.x, event.y, self.offset_x, self.offset_y)
+
+    def on_pan(self, event):
+        if not self._pan_start:
+            return
+        x, y, offset_x, offset_y = self._pan_start
+        self.offset_x = offset_x - (event.x - x) / self.zoom
+        self.offset_y = offset_y - (event.y - y) / self.zoom
+        self.changed()
+
+    def _visible_tiles(self, scale):
+        """(tx, ty) of the tiles of a level intersecting the canvas"""
+        level_width, level_height = self.pyramid.level_size(scale)
+        width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+
+        # Visible part of the level in level pixels
+        x0 = max(0.0, self.offset_x * scale)
+        y0 = max(0.0, self.offset_y * scale)
+        x1 = min(level_width, (self.offset_x + width / self.zoom) * scale)
+        y1 = min(level_height, (self.offset_y + height / self.zoom) * scale)
+        return [(tx, ty)
+                for ty in range(int(y0 // TILE_SIZE), math.ceil(y1 / TILE_SIZE))
+                for tx in range(int(x0 // TILE_SIZE), math.ceil(x1 / TILE_SIZE))]
+
+    def render(self):
+        if not self.pyramid:
+            return
+        pyramid = self.pyramid
+
+        # Scaled tiles depend on the zoom, drop them when it changes
+        if self._items_zoom != self.zoom:
+            self.clear()
+            self._items_zoom = self.zoom
+
+        scale = pyramid.scale_for(self.zoom)
+        positions = self._visible_tiles(scale)
+        new_positions = [position for position in positions if (scale,) + position not in self._items]
+        tiles = pyramid.tiles(scale, new_positions)
+        if tiles is None:
+            # Show the preview until the tiles in view are decoded
+            scale = pyramid.preview_scale
+            positions = self._visible_tiles(scale)
+            new_positions = [position for position in positions if (scale,) + position not in self._items]
+            tiles = pyramid.tiles(scale, new_positions)
+            if self._pending_render is None:
+                self._pending_render = self.canvas.after(50, self._render_later)
+        new_tiles = dict(zip(new_positions, tiles))
+
+        factor = self.zoom / scale
+        visible = set()
+        for tx, ty in positions:
+            key = (scale, tx, ty)
+            x = round(tx * TILE_SIZE * factor - self.offset_x * self.zoom)
+            y = round(ty * TILE_SIZE * factor - self.offset_y * self.zoom)
+            if key in self._items:
+                self.canvas.coords(self._items[key][0], x, y)
+            else:
+                tile = new_tiles[(tx, ty)]
+                if factor != 1:
+                    size = (max(1, math.ceil(tile.width * factor)), max(1, math.ceil(tile.height * factor)))
+                    tile = tile.resize(size, Image.Resampling.BILINEAR)
+                photo = ImageTk.PhotoImage(tile)
+                item = self.canvas.create_image(x, y, anchor=tk.NW, image=photo, tags="tile")
+                self._items[key] = (item, photo)
+            visible.add(key)
+
+        for key in list(self._items):
+            if key not in visible:
+                self.canvas.delete(self._items.pop(key)[0])
+        self.canvas.tag_lower("tile")
+
+    def _render_later(self):
+        self._pending_render = None
+        self.render()
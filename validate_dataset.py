@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from dataset_utils import IMG_RE, box_frame, find_image, frame_scale, is_url, load_dataset, parse_boxes, scale_boxes
+from image_index import ImageIndex
+
+# Set in every worker process by _init_worker
+_IMAGES = None
+
+
+def _init_worker(by_name):
+    global _IMAGES
+    _IMAGES = by_name
+
+
+def _tag_issue(text, tag, expected):
+    opened, closed = text.count(f"<{tag}>"), text.count(f"</{tag}>")
+    if opened != closed or opened != expected:
+        return f"malformed <{tag}> tags: {opened} opened, {closed} closed, {expected} well-formed"
+    return None
+
+
+def check_entry(entry, images):
+    """Issues of a single entry; images maps basenames to ImageIndex records"""
+    issues = []
+
+    def issue(kind, message, turn=None):
+        issues.append({"id": entry.get('id'), "turn": turn, "kind": kind, "message": message})
+
+    conversations = entry.get('conversations')
+    if not isinstance(conversations, list) or not conversations:
+        issue("structure", "entry has no conversations")
+        return issues
+
+    image_ref = find_image(entry)
+    if image_ref and not is_url(image_ref):
+        candidates = images.get(os.path.basename(image_ref), [])
+        if len({c.get('sha256') for c in candidates}) > 1:
+            issue("ambiguous_image", f"{image_ref} matches {len(candidates)} different files")
+
+    # Boxes of an answer refer to the latest image shown before it
+    image = None
+    frame = box_frame(entry)
+
+    for i, msg in enumerate(conversations):
+        turn = i // 2
+        if msg.get('from') != ('user' if i % 2 == 0 else 'assistant'):
+            issue("structure", f"message {i} is from {msg.get('from')!r}", turn)
+        value = msg.get('value', "")
+
+        refs = IMG_RE.findall(value)
+        problem = _tag_issue(value, "img", len(refs))
+        if problem:
+            issue("malformed_tags", problem, turn)
+        for ref in refs:
+            if is_url(ref):
+                continue
+            candidates = images.get(os.path.basename(ref))
+            image = candidates[0] if candidates else None
+            if not candidates:
+                issue("missing_image", f"{ref} not found", turn)
+            elif "error" in candidates[0]:
+                issue("unreadable_image", f"{ref}: {candidates[0]['error']}", turn)
+
+        if msg.get('from') != 'assistant':
+            continue
+        boxes = parse_boxes(value)
+        problem = _tag_issue(value, "box", len(boxes))
+        if problem:
+            issue("malformed_tags", problem, turn)
+        problem = _tag_issue(value, "ref", value.count("</ref>"))
+        if problem:
+            issue("malformed_tags", problem, turn)
+
+        for ref, (x1, y1, x2, y2) in boxes:
+            if x1 >= x2 or y1 >= y2:
+                issue("degenerate_box", f"{ref}: ({x1},{y1}),({x2},{y2})", turn)
+        if image and "width" in image:
+            width, height = image['width'], image['height']
+            for (ref, box), (_, (_, _, x2, y2)) in zip(boxes, scale_boxes(boxes, *frame_scale(frame, width, height))):
+                if x2 > width or y2 > height:
+                    issue("box_out_of_bounds",
+                          f"{ref}: ({box[0]},{box[1]}),({box[2]},{box[3]}) in {frame} pixels "
+                          f"outside {width}x{height}", turn)
+    return issues
+
+
+def _check_chunk(entries):
+    issues = []
+    for entry in entries:
+        issues.extend(check_entry(entry, _IMAGES))
+    return issues
+
+
+def validate(paths, index, workers=None, chunk_size=256):
+    """Validate dataset files against an up-to-date ImageIndex; returns a list of issues"""
+    issues = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(index.by_name,)) as pool:
+        for path in paths:
+            entries = load_dataset(path)
+
+            counts = Counter(entry.get('id') for entry in entries)
+            for entry_id, count in counts.items():
+                if count > 1:
+                    issues.append({"file": path, "id": entry_id, "turn": None, "kind": "duplicate_id",
+                                   "message": f"id used by {count} entries"})
+
+            chunks = [entries[i:i + chunk_size] for i in range(0, len(entries), chunk_size)]
+            for chunk_issues in pool.map(_check_chunk, chunks):
+                for item in chunk_issues:
+                    issues.append(dict(item, file=path))
+    return issues
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check Dataset.json-format files for broken entries")
+    parser.add_argument("paths", nargs="+", help="Dataset.json-format files")
+    parser.add_argument("--roots", nargs="+", help="Image folders (default: the folders of the dataset files)")
+    parser.add_argument("--index", help="Image index cache (default: .image_index.json in the first root)")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    roots = args.roots or sorted({os.path.dirname(os.path.abspath(path)) for path in args.paths})
+    index = ImageIndex(roots, args.index or os.path.join(roots[0], ".image_index.json"))
+    described = index.update(args.workers)
+
+    issues = validate(args.paths, index, args.workers)
+    report = {
+        "images": len(index.images),
+        "described_images": described,
+        "issues": dict(Counter(item['kind'] for item in issues)),
+        "details": issues,
+    }
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+    sys.exit(1 if issues else 0)
+
+
+if __name__ == "__main__":
+    main()